@@ -0,0 +1,124 @@
+#
+# Copyright 2022 DMetaSoul
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import numpy as np
+
+from service_config import MILVUS_METRICS
+
+
+def as_matrix(vectors):
+    matrix = np.asarray([list(vector) for vector in vectors] if not isinstance(vectors, np.ndarray) else vectors,
+                        dtype=np.float32)
+    if matrix.ndim != 2:
+        raise ValueError("ann index vectors must be a 2d matrix!")
+    return matrix
+
+
+class BruteForceAnnIndex(object):
+    """
+    exact numpy stand-in of a milvus collection, search returns (ids, distances) per query like milvus does:
+    larger inner product first for IP, smaller squared euclidean distance first for L2.
+    search params such as nprobe or ef are accepted and ignored, results are the recall upper bound.
+    """
+
+    def __init__(self, ids, vectors, metric="IP"):
+        if metric not in MILVUS_METRICS:
+            raise ValueError("ann index metric must be one of %s!" % ", ".join(MILVUS_METRICS))
+        self.ids = np.asarray(list(ids), dtype=object)
+        self.vectors = as_matrix(vectors)
+        if len(self.ids) != self.vectors.shape[0]:
+            raise ValueError("ann index ids and vectors size not match!")
+        self.metric = metric
+        self.norms = (self.vectors * self.vectors).sum(axis=1)
+
+    def distances(self, queries):
+        products = queries @ self.vectors.T
+        if self.metric == "IP":
+            return products
+        return (queries * queries).sum(axis=1)[:, None] - 2 * products + self.norms[None, :]
+
+    def search(self, queries, top_k, **search_params):
+        queries = as_matrix(queries)
+        top_k = min(int(top_k), len(self.ids))
+        if top_k <= 0 or queries.shape[0] == 0:
+            return [([], []) for _ in range(queries.shape[0])]
+        distances = self.distances(queries)
+        order = -distances if self.metric == "IP" else distances
+        # argpartition keeps the top_k unordered, only those get sorted
+        candidates = np.argpartition(order, top_k - 1, axis=1)[:, :top_k]
+        results = list()
+        for row, positions in enumerate(candidates):
+            positions = positions[np.argsort(order[row, positions], kind="stable")]
+            results.append((self.ids[positions].tolist(), distances[row, positions].tolist()))
+        return results
+
+
+class FaissAnnIndex(BruteForceAnnIndex):
+    """faiss backed stand-in building the same index type as the milvus collection, needs faiss installed"""
+
+    def __init__(self, ids, vectors, metric="IP", index_type="FLAT", index_params=None):
+        import faiss
+        super().__init__(ids, vectors, metric)
+        index_params = index_params or {}
+        dim = self.vectors.shape[1]
+        faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == "IP" else faiss.METRIC_L2
+        if index_type == "HNSW":
+            self.index = faiss.IndexHNSWFlat(dim, int(index_params.get("M", 16)), faiss_metric)
+            self.index.hnsw.efConstruction = int(index_params.get("efConstruction", 200))
+        elif index_type.startswith("IVF"):
+            quantizer = faiss.IndexFlatIP(dim) if metric == "IP" else faiss.IndexFlatL2(dim)
+            nlist = min(int(index_params.get("nlist", 1024)), len(self.ids))
+            self.index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss_metric)
+            self.index.train(self.vectors)
+        else:
+            self.index = faiss.IndexFlatIP(dim) if metric == "IP" else faiss.IndexFlatL2(dim)
+        self.index.add(self.vectors)
+
+    def search(self, queries, top_k, **search_params):
+        queries = as_matrix(queries)
+        top_k = min(int(top_k), len(self.ids))
+        if top_k <= 0 or queries.shape[0] == 0:
+            return [([], []) for _ in range(queries.shape[0])]
+        if "nprobe" in search_params and hasattr(self.index, "nprobe"):
+            self.index.nprobe = int(search_params["nprobe"])
+        if "ef" in search_params and hasattr(self.index, "hnsw"):
+            self.index.hnsw.efSearch = int(search_params["ef"])
+        distances, positions = self.index.search(queries, top_k)
+        results = list()
+        for row_distances, row_positions in zip(distances, positions):
+            keep = row_positions >= 0
+            results.append((self.ids[row_positions[keep]].tolist(), row_distances[keep].tolist()))
+        return results
+
+
+def new_ann_index(ids, vectors, options=None, backend="numpy"):
+    """build a stand-in from the milvusSearch field action options emitted by OnlineGenerator"""
+    options = options or {}
+    metric = options.get("metricType", "IP")
+    if backend == "faiss":
+        return FaissAnnIndex(ids, vectors, metric, options.get("indexType", "FLAT"), options.get("indexParams"))
+    if backend != "numpy":
+        raise ValueError("ann index backend must be numpy or faiss!")
+    return BruteForceAnnIndex(ids, vectors, metric)
+
+
+def recall_at_k(results, exact_results):
+    """mean overlap of approximate ids with the exact ids per query, to pick nprobe/ef offline"""
+    if not exact_results:
+        return 1.0
+    total = 0.0
+    for (ids, _), (exact_ids, _) in zip(results, exact_results):
+        total += len(set(ids) & set(exact_ids)) / len(exact_ids) if exact_ids else 1.0
+    return total / len(exact_results)
@@ -0,0 +1,190 @@
+#
+# Copyright 2022 DMetaSoul
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import argparse
+import json
+import math
+import os
+import sys
+
+from attrs import asdict, define, evolve
+
+from online_estimator import CostProfile, estimate_latency
+from online_flow import DockerInfo, DockerResources
+from online_generator import DEFAULT_MODEL_IMAGE, DEFAULT_RECOMMEND_IMAGE, OnlineGenerator, get_data_sources
+
+MB = 1024 * 1024
+
+
+@define
+class CapacityProfile(object):
+    # bson documents and indexes take roughly this much more than the exported json lines
+    mongo_storage_factor: float = 1.2
+    mongo_base_mb: int = 1024
+    mongo_lookups_per_core: int = 5000
+    model_memory_factor: float = 2.0
+    model_base_mb: int = 512
+    recommend_memory_mb: int = 2048
+    recommend_qps_per_core: int = 500
+    headroom: float = 1.3
+    min_cpus: float = 0.5
+
+
+def format_mb(size_mb):
+    return "%dm" % int(math.ceil(size_mb))
+
+
+def file_size(path):
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def directory_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def dataset_table_size(data_dir, table):
+    for suffix in (".json", ".jsonl"):
+        path = os.path.join(data_dir, "%s%s" % (table, suffix))
+        if os.path.isfile(path):
+            return file_size(path)
+    return 0
+
+
+class CapacityPlanner(object):
+    """
+    suggest docker resources for the mongo and model serving containers of an OnlineFlow.
+    data_dir holds one <table>.json per collection, models_dir one directory per exported model.
+    """
+
+    def __init__(self, configure, data_dir=None, models_dir=None, target_qps=100, profile=None, cost_profile=None):
+        self.configure = configure
+        self.data_dir = data_dir
+        self.models_dir = models_dir
+        self.target_qps = target_qps
+        self.profile = profile or CapacityProfile()
+        self.cost_profile = cost_profile or CostProfile()
+
+    def cpus(self, cores):
+        return round(max(self.profile.min_cpus, cores * self.profile.headroom), 1)
+
+    def source_calls_per_request(self):
+        report = estimate_latency(self.configure, self.cost_profile)
+        return max([scene["source_calls"] for scene in report.values()] or [0])
+
+    def plan_mongo(self, name, calls_per_request):
+        tables = [source.table for source in get_data_sources(self.configure) if source.serviceName == name]
+        data_bytes = sum(dataset_table_size(self.data_dir, table) for table in tables) if self.data_dir else 0
+        working_set_mb = data_bytes * self.profile.mongo_storage_factor / MB
+        # wiredtiger caches half of (memory - 1g), size memory so the working set fits in that cache
+        memory_mb = (self.profile.mongo_base_mb + 2 * working_set_mb) * self.profile.headroom
+        cores = self.target_qps * calls_per_request / self.profile.mongo_lookups_per_core
+        return DockerResources(cpus=self.cpus(cores), mem_limit=format_mb(memory_mb),
+                               mem_reservation=format_mb(self.profile.mongo_base_mb + working_set_mb)), {
+            "tables": tables, "data_bytes": data_bytes}
+
+    def rank_candidates(self):
+        """rows a rank model scores per request, capped by the rank services maxReservation"""
+        rows = self.cost_profile.matcher_fanout * self.cost_profile.user_profile_rows
+        # with a latency_budget the generator has already set maxReservation to the planned candidate count
+        recommend_config = OnlineGenerator(configure=self.configure).build_server_config().recommend_service
+        limits = [service.options.get("maxReservation") for service in recommend_config.services
+                  if service.name.startswith("rank_") and (service.options or {}).get("maxReservation")]
+        return min([rows] + limits)
+
+    def plan_model(self):
+        rank_models = [model.model for model in self.configure.rank_models or []]
+        twotower_models = [model.model for model in self.configure.twotower_models or []]
+        models = rank_models + twotower_models
+        model_bytes = sum(directory_size(os.path.join(self.models_dir, model)) for model in models) \
+            if self.models_dir else 0
+        memory_mb = (self.profile.model_base_mb + self.profile.model_memory_factor * model_bytes / MB) * \
+            self.profile.headroom
+        rows = self.rank_candidates() if rank_models else 0
+        # a user tower embeds one row per request
+        inference_ms = len(rank_models) * (self.cost_profile.inference_latency_ms +
+                                           rows * self.cost_profile.inference_row_cost_ms) + \
+            len(twotower_models) * (self.cost_profile.inference_latency_ms + self.cost_profile.inference_row_cost_ms)
+        cores = self.target_qps * inference_ms / 1000.0
+        return DockerResources(cpus=self.cpus(cores), mem_limit=format_mb(memory_mb),
+                               mem_reservation=format_mb(self.profile.model_base_mb + model_bytes / MB),
+                               shm_size=format_mb(max(64, model_bytes / MB))), {
+            "models": models, "model_bytes": model_bytes, "rank_rows": rows}
+
+    def plan_recommend(self):
+        memory_mb = self.profile.recommend_memory_mb * self.profile.headroom
+        return DockerResources(cpus=self.cpus(self.target_qps / self.profile.recommend_qps_per_core),
+                               mem_limit=format_mb(memory_mb),
+                               mem_reservation=format_mb(self.profile.recommend_memory_mb)), {}
+
+    def plan(self):
+        calls_per_request = self.source_calls_per_request()
+        plan = dict()
+        plan["recommend"] = self.plan_recommend()
+        for name, info in (self.configure.services or {}).items():
+            if str(info.kind).lower() == "mongodb":
+                plan[name] = self.plan_mongo(name, calls_per_request)
+        model_services = [name for name in (self.configure.dockers or {}) if str(name).startswith("model")]
+        for name in model_services or ["model"]:
+            plan[name] = self.plan_model()
+        return plan
+
+    def report(self):
+        return {name: {"resources": {key: value for key, value in asdict(resources).items() if value is not None},
+                       "inputs": inputs}
+                for name, (resources, inputs) in self.plan().items()}
+
+    def apply(self):
+        """return a copy of the OnlineFlow with planned resources, resources already set in dockers are kept"""
+        dockers = dict(self.configure.dockers or {})
+        for name, (resources, _) in self.plan().items():
+            info = dockers.get(name)
+            if info is None and name == "recommend":
+                info = DockerInfo(DEFAULT_RECOMMEND_IMAGE, {})
+            elif info is None and str(name).startswith("model"):
+                info = DockerInfo(DEFAULT_MODEL_IMAGE, {})
+            elif info is None:
+                # mongo running outside of the generated compose
+                continue
+            dockers[name] = evolve(info, resources=merge_resources(resources, info.resources))
+        return evolve(self.configure, dockers=dockers)
+
+
+def merge_resources(planned, configured):
+    if configured is None:
+        return planned
+    values = asdict(planned)
+    values.update({key: value for key, value in asdict(configured).items() if value is not None})
+    return DockerResources(**values)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="suggest container resources for the demo online flow")
+    parser.add_argument("--data-dir", help="directory with one <table>.json per collection")
+    parser.add_argument("--models-dir", help="directory with one exported model per rank/twotower model")
+    parser.add_argument("--qps", type=float, default=100)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    from online_generator import get_demo_jpa_flow
+    args = parse_args(sys.argv[1:])
+    planner = CapacityPlanner(get_demo_jpa_flow(), args.data_dir, args.models_dir, args.qps)
+    print(json.dumps(planner.report(), indent=2))
@@ -13,24 +13,320 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import base64
+import json
+import os
+import threading
+import time
+import zlib
+
 import consul
 
+from common import ContentHash
+
+# consul kv values are capped at 512KB, keep every stored value well below it
+CONSUL_VALUE_LIMIT = 512 * 1024
+CHUNK_SIZE = 384 * 1024
+COMPRESS_THRESHOLD = 32 * 1024
+PAYLOAD_MAGIC = "metaspore-chunked-v1"
+PAYLOAD_PREFIX = ('{"magic": "%s"' % PAYLOAD_MAGIC).encode("utf-8")
+
 
 class Consul(object):
     def __init__(self, host, port, token=None):
         self._consul = consul.Consul(host, port, token=token)
 
     def setConfig(self, key, value):
+        if isinstance(value, str):
+            value = value.encode("utf-8")
         self._consul.kv.put(key, value)
 
     def getConfig(self, key):
         index, data = self._consul.kv.get(key)
         print(data['Value'])
 
+    def getValue(self, key):
+        index, value = self.getEntry(key)
+        return value.decode("utf-8") if value is not None else None
+
+    def getEntry(self, key):
+        """return (ModifyIndex, value bytes), ModifyIndex is 0 when the key does not exist"""
+        index, data = self._consul.kv.get(key)
+        if not data:
+            return 0, None
+        return data['ModifyIndex'], data.get('Value')
+
+    def casConfig(self, key, value, index):
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        return bool(self._consul.kv.put(key, value, cas=index))
+
+    def watchEntry(self, key, index, wait=30):
+        """consul blocking query, return (ModifyIndex, value) once key changes past index or wait seconds pass"""
+        index, data = self._consul.kv.get(key, index=index, wait="%ds" % wait)
+        if not data:
+            return index or 0, None
+        return data['ModifyIndex'], data.get('Value')
+
     def deletConfig(self, key):
         self._consul.kv.delete(key)
 
+    def deleteTree(self, prefix):
+        self._consul.kv.delete(prefix, recurse=True)
+
+
+class MemoryConsul(object):
+    """in-memory stand-in for Consul kv with ModifyIndex and check-and-set semantics"""
+
+    def __init__(self):
+        self._data = dict()
+        self._index = 0
+        self._lock = threading.Condition()
+
+    def setConfig(self, key, value):
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        self._index += 1
+        self._data[key] = (self._index, value)
+        self._lock.notify_all()
+
+    def getConfig(self, key):
+        print(self.getEntry(key)[1])
+
+    def getValue(self, key):
+        index, value = self.getEntry(key)
+        return value.decode("utf-8") if value is not None else None
+
+    def getEntry(self, key):
+        with self._lock:
+            return self._data.get(key, (0, None))
+
+    def casConfig(self, key, value, index):
+        with self._lock:
+            if self._data.get(key, (0, None))[0] != index:
+                return False
+            self._put(key, value)
+            return True
+
+    def watchEntry(self, key, index, wait=30):
+        deadline = time.monotonic() + wait
+        with self._lock:
+            while self._data.get(key, (0, None))[0] <= index:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._lock.wait(remaining)
+            return self._data.get(key, (0, None))
+
+    def deletConfig(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def deleteTree(self, prefix):
+        with self._lock:
+            for key in [key for key in self._data if key.startswith(prefix)]:
+                self._data.pop(key)
+
+    def keys(self, prefix=""):
+        with self._lock:
+            return sorted(key for key in self._data if key.startswith(prefix))
+
+
+class FileConsul(MemoryConsul):
+    """MemoryConsul persisted to a json file, for offline runs and tests"""
+
+    def __init__(self, path):
+        super().__init__()
+        self._path = path
+        if os.path.exists(path):
+            with open(path) as store:
+                data = json.load(store)
+            self._index = data.get("index", 0)
+            self._data = {key: (index, base64.b64decode(value)) for key, (index, value) in data["data"].items()}
+
+    def _put(self, key, value):
+        super()._put(key, value)
+        self._save()
+
+    def _save(self):
+        data = {key: (index, base64.b64encode(value).decode("ascii")) for key, (index, value) in self._data.items()}
+        temp_path = "%s.tmp" % self._path
+        with open(temp_path, "w") as store:
+            json.dump({"index": self._index, "data": data}, store)
+        os.replace(temp_path, self._path)
+
+    def deletConfig(self, key):
+        super().deletConfig(key)
+        with self._lock:
+            self._save()
+
+    def deleteTree(self, prefix):
+        super().deleteTree(prefix)
+        with self._lock:
+            self._save()
+
+
+_CLIENTS = dict()
+_CLIENTS_LOCK = threading.Lock()
+
+
+def getConsul(host="localhost", port=8500, token=None):
+    """one pooled client (and http session) per consul agent"""
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get((host, port, token))
+        if client is None:
+            client = Consul(host, port, token=token)
+            _CLIENTS[(host, port, token)] = client
+        return client
+
+
+def casWrite(client, key, update, retries=5, backoff=0.05):
+    """
+    read-modify-write key with check-and-set on ModifyIndex.
+    update(old value bytes or None) returns the new value, or None to leave the key untouched.
+    """
+    for attempt in range(retries + 1):
+        index, old_value = client.getEntry(key)
+        value = update(old_value)
+        if value is None:
+            return False
+        if client.casConfig(key, value, index):
+            return True
+        time.sleep(backoff * (2 ** attempt))
+    raise ValueError("consul key %s check-and-set failed after %d retries!" % (key, retries))
+
+
+def encodePayload(key, value, chunk_size=CHUNK_SIZE, compress_threshold=COMPRESS_THRESHOLD):
+    """return (stored value, {chunk key: chunk bytes}), values up to compress_threshold are stored as they are"""
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    if len(value) <= compress_threshold and len(value) <= CONSUL_VALUE_LIMIT:
+        return value, {}
+    digest = ContentHash(value)
+    data = zlib.compress(value)
+    chunks = dict()
+    for offset in range(0, len(data), chunk_size):
+        chunks["%s/.chunks/%s/%04d" % (key, digest[:16], offset // chunk_size)] = data[offset:offset + chunk_size]
+    manifest = {"magic": PAYLOAD_MAGIC, "encoding": "zlib", "hash": digest, "size": len(value),
+                "chunks": list(chunks.keys())}
+    return json.dumps(manifest).encode("utf-8"), chunks
+
+
+def decodeManifest(value):
+    if not value or not value.startswith(PAYLOAD_PREFIX):
+        return None
+    return json.loads(value)
+
+
+def putPayload(client, key, value, chunk_size=CHUNK_SIZE, compress_threshold=COMPRESS_THRESHOLD, retries=5):
+    """
+    write value to key, compressing and splitting it across chunk keys behind a manifest when it is large.
+    chunks are written under a content addressed prefix first and the key itself is switched with check-and-set,
+    so readers never see a half written payload.
+    """
+    if chunk_size > CONSUL_VALUE_LIMIT:
+        raise ValueError("consul chunk size must not exceed %d bytes!" % CONSUL_VALUE_LIMIT)
+    stored, chunks = encodePayload(key, value, chunk_size, compress_threshold)
+    for chunk_key, chunk in chunks.items():
+        client.setConfig(chunk_key, chunk)
+    replaced = dict()
+
+    def update(old_value):
+        replaced["manifest"] = decodeManifest(old_value)
+        return stored
+
+    casWrite(client, key, update, retries)
+    old_manifest = replaced.get("manifest")
+    if old_manifest:
+        for chunk_key in old_manifest.get("chunks", []):
+            if chunk_key not in chunks:
+                client.deletConfig(chunk_key)
+
+
+def getPayload(client, key):
+    index, value = client.getEntry(key)
+    manifest = decodeManifest(value)
+    if manifest is None:
+        return value.decode("utf-8") if value is not None else None
+    data = b"".join(client.getEntry(chunk_key)[1] or b"" for chunk_key in manifest["chunks"])
+    value = zlib.decompress(data)
+    if ContentHash(value) != manifest["hash"]:
+        raise ValueError("consul key %s payload hash mismatch!" % key)
+    return value.decode("utf-8")
+
+
+def deletePayload(client, key):
+    manifest = decodeManifest(client.getEntry(key)[1])
+    if manifest:
+        for chunk_key in manifest.get("chunks", []):
+            client.deletConfig(chunk_key)
+    client.deletConfig(key)
+
+
+def waitForValue(client, key, expected, timeout=60, wait=10):
+    """watch key with blocking queries until its value equals expected, return False on timeout"""
+    if isinstance(expected, str):
+        expected = expected.encode("utf-8")
+    deadline = time.monotonic() + timeout
+    index, value = client.getEntry(key)
+    while value != expected:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        index, value = client.watchEntry(key, index, max(1, int(min(wait, remaining))))
+    return True
+
+
+def getServiceConfigVersion(client, prefix="config", context="recommend", manifest_key="manifest"):
+    manifest = client.getValue("%s/%s/%s" % (prefix, context, manifest_key))
+    return json.loads(manifest).get("version") if manifest else None
+
+
+def putServiceConfig(config, host="localhost", port=8500, prefix="config", context="recommend", data_key="data",
+                     client=None):
+    """
+    the recommend service reads the data key as plain yaml, which is how it is written.
+    only a config over the consul value limit falls back to the chunked payload, readable with getPayload.
+    """
+    putPayload(client or getConsul(host, port), "%s/%s/%s" % (prefix, context, data_key), config,
+               compress_threshold=CONSUL_VALUE_LIMIT)
+
+
+def sectionsVersion(sections, prefix="config", context="recommend"):
+    """manifest version of rendered sections {name: (content, hash)}"""
+    return ContentHash(json.dumps({name: {"key": "%s/%s/%s" % (prefix, context, name), "hash": digest}
+                                   for name, (_, digest) in sections.items()}, sort_keys=True))
 
-def putServiceConfig(config, host="localhost", port=8500, prefix="config", context="recommend", data_key="data"):
-    Consul(host, port).setConfig("%s/%s/%s" % (prefix, context, data_key), config)
 
+def putServiceConfigSections(sections, host="localhost", port=8500, prefix="config", context="recommend",
+                             manifest_key="manifest", client=None, retries=5):
+    """write only the sections whose hash differs from the manifest, then update the manifest"""
+    client = client or getConsul(host, port)
+    manifest_path = "%s/%s/%s" % (prefix, context, manifest_key)
+    for attempt in range(retries + 1):
+        index, manifest = client.getEntry(manifest_path)
+        old_sections = json.loads(manifest).get("sections", {}) if manifest else {}
+        new_sections = dict()
+        changed = list()
+        for name, (content, digest) in sections.items():
+            key = "%s/%s/%s" % (prefix, context, name)
+            new_sections[name] = {"key": key, "hash": digest}
+            if old_sections.get(name, {}).get("hash") != digest:
+                putPayload(client, key, content, retries=retries)
+                changed.append(name)
+        removed = [info["key"] for name, info in old_sections.items() if name not in new_sections]
+        changed.extend([name for name in old_sections if name not in new_sections])
+        if not changed and manifest:
+            return changed
+        version = ContentHash(json.dumps(new_sections, sort_keys=True))
+        if client.casConfig(manifest_path, json.dumps({"version": version, "sections": new_sections},
+                                                      sort_keys=True), index):
+            for key in removed:
+                deletePayload(client, key)
+            return changed
+        time.sleep(0.05 * (2 ** attempt))
+    raise ValueError("consul key %s check-and-set failed after %d retries!" % (manifest_path, retries))
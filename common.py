@@ -13,44 +13,196 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import hashlib
+import io
+import json
+
+import attrs
 import ruamel.yaml
 from attr import define
 
 S = ruamel.yaml.scalarstring.DoubleQuotedScalarString
 
+_FIELD_PLANS = dict()
+
+
+class FieldPlan(object):
+    """how one attrs field of a config class is initialized and dumped, built once per class"""
+    __slots__ = ("name", "key", "single", "dump", "default", "factory")
+
+    def __init__(self, attribute):
+        self.name = attribute.name
+        self.key = attribute.metadata.get("key", attribute.name)
+        self.single = attribute.metadata.get("single")
+        self.dump = attribute.metadata.get("dump")
+        self.default = None
+        self.factory = None
+        if isinstance(attribute.default, attrs.Factory):
+            self.factory = attribute.default.factory
+        elif attribute.default is not attrs.NOTHING:
+            self.default = attribute.default
+
+    def new_default(self):
+        return self.factory() if self.factory is not None else self.default
+
+
+def GetFieldPlan(cls):
+    plan = _FIELD_PLANS.get(cls)
+    if plan is None:
+        plan = tuple(FieldPlan(attribute) for attribute in attrs.fields(cls))
+        _FIELD_PLANS[cls] = plan
+    return plan
+
+
+def ConfigField(key=None, single=None, dump=None, **kwargs):
+    metadata = dict()
+    if key:
+        metadata["key"] = key
+    if single:
+        metadata["single"] = single
+    if dump:
+        metadata["dump"] = dump
+    return attrs.field(metadata=metadata, **kwargs)
+
+
+def DumpValue(value):
+    if isinstance(value, BaseConfig):
+        return value.to_dict()
+    if isinstance(value, list) and value and isinstance(value[0], BaseConfig):
+        return [x.to_dict() for x in value]
+    if isinstance(value, dict) and value and isinstance(next(iter(value.values())), BaseConfig):
+        return {key: x.to_dict() for key, x in value.items()}
+    return value
+
 
 def Object2Dict(obj):
-    return {name: getattr(obj, name) for name in dir(obj)
-            if not name.startswith("__") and getattr(obj, name) is not None and not callable(getattr(obj, name))}
+    return {name: getattr(obj, name) for name in GetObjFields(obj)}
 
 
 def GetObjFields(obj):
-    return [name for name in dir(obj)
-            if not name.startswith("__") and getattr(obj, name) is not None and not callable(getattr(obj, name))]
+    if attrs.has(type(obj)):
+        return [item.name for item in GetFieldPlan(type(obj)) if getattr(obj, item.name, None) is not None]
+    return [name for name, value in vars(obj).items()
+            if not name.startswith("__") and value is not None and not callable(value)]
 
 
 class BaseConfig(object):
+    __slots__ = ()
+
     def __init__(self, **kwargs):
-        self.dict_data = {}
         for key, value in kwargs.items():
-            self.__setattr__(key, value)
-            if value is not None:
-                self.dict_data[key] = value
+            if not hasattr(type(self), key):
+                raise ValueError("%s has no config field: %s" % (type(self).__name__, key))
+            setattr(self, key, value)
 
     def to_dict(self):
-        return self.dict_data if self.dict_data else Object2Dict(self)
+        data = dict()
+        for item in GetFieldPlan(type(self)):
+            value = getattr(self, item.name)
+            if value is None or (not value and isinstance(value, (str, list, dict))):
+                continue
+            if item.dump is not None:
+                data[item.key] = item.dump(value)
+            elif item.single and len(value) == 1:
+                data[item.single] = DumpValue(value[0])
+            else:
+                data[item.key] = DumpValue(value)
+        return data
 
 
 @define
 class BaseDefaultConfig(BaseConfig):
     def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        for item in self.__attrs_attrs__:
-            if item.name not in kwargs:
-                self.__setattr__(item.name, item.default)
+        matched = 0
+        for item in GetFieldPlan(type(self)):
+            if item.name in kwargs:
+                setattr(self, item.name, kwargs[item.name])
+                matched += 1
+            else:
+                setattr(self, item.name, item.new_default())
+        if matched != len(kwargs):
+            super().__init__(**kwargs)
+
+
+class FastYamlRepresenter(ruamel.yaml.representer.SafeRepresenter):
+    pass
+
 
+FastYamlRepresenter.add_representer(
+    S, lambda representer, data: representer.represent_scalar("tag:yaml.org,2002:str", data, style='"'))
 
-def DumpToYaml(obj):
+
+def NewYamlDumper(fast=False):
+    if not fast:
+        yaml = ruamel.yaml.YAML(typ="rt")
+    else:
+        # pure=False picks the libyaml based emitter when ruamel.yaml.clib is installed
+        yaml = ruamel.yaml.YAML(typ="safe", pure=False)
+        yaml.Representer = FastYamlRepresenter
+        yaml.default_flow_style = False
+    yaml.width = 160
+    return yaml
+
+
+def DumpYaml(data, stream, fast=False):
+    NewYamlDumper(fast).dump(data, stream)
+
+
+def DumpJson(data, stream):
+    if isinstance(stream, io.TextIOBase):
+        json.dump(data, stream, ensure_ascii=False, separators=(",", ":"))
+        return
+    writer = io.TextIOWrapper(stream, encoding="utf-8", write_through=True)
+    json.dump(data, writer, ensure_ascii=False, separators=(",", ":"))
+    writer.detach()
+
+
+def DumpMsgpack(data, stream):
+    try:
+        import msgpack
+    except ImportError:
+        raise ValueError("config format msgpack need the msgpack package installed!")
+    if isinstance(stream, io.TextIOBase):
+        raise ValueError("config format msgpack need a binary stream!")
+    msgpack.pack(data, stream)
+
+
+CONFIG_DUMPERS = {
+    "yaml": lambda data, stream: DumpYaml(data, stream),
+    "yaml-fast": lambda data, stream: DumpYaml(data, stream, fast=True),
+    "json": DumpJson,
+    "msgpack": DumpMsgpack,
+}
+
+
+def DumpConfig(obj, stream=None, fmt="yaml"):
+    """
+    render a config object as yaml, yaml-fast, json or msgpack.
+    with a stream (text or binary file, socket.makefile(...)) the output is written there and None is returned,
+    otherwise the rendered str (bytes for msgpack) is returned.
+    """
+    dumper = CONFIG_DUMPERS.get(fmt)
+    if dumper is None:
+        raise ValueError("config format %s is not supported, use one of %s" % (fmt, list(CONFIG_DUMPERS.keys())))
     if isinstance(obj, BaseConfig):
-        return ruamel.yaml.round_trip_dump(obj.to_dict(), width=160)
-    return ruamel.yaml.round_trip_dump(Object2Dict(obj), width=160)
+        data = obj.to_dict()
+    elif isinstance(obj, dict):
+        data = obj
+    else:
+        data = Object2Dict(obj)
+    if stream is not None:
+        dumper(data, stream)
+        return None
+    buffer = io.BytesIO() if fmt == "msgpack" else io.StringIO()
+    dumper(data, buffer)
+    return buffer.getvalue()
+
+
+def DumpToYaml(obj, stream=None):
+    return DumpConfig(obj, stream, "yaml")
+
+
+def ContentHash(content):
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
@@ -17,7 +17,7 @@ from attrs import define
 from attrs import field
 from typing import Literal
 
-from common import DumpToYaml, S, BaseDefaultConfig
+from common import DumpToYaml, S, BaseDefaultConfig, ConfigField
 
 
 @define
@@ -29,88 +29,174 @@ class DockerBuildInfo(BaseDefaultConfig):
         super().__init__(**kwargs)
 
 
+def dump_ports(ports):
+    return [S("%d:%d" % (port, port)) for port in ports]
+
+
+def dump_depends_on(depends_on):
+    if isinstance(depends_on, dict):
+        return {S(name): dict(condition) for name, condition in depends_on.items()}
+    return [S(name) for name in depends_on]
+
+
+def resource_kwargs(resources):
+    """OnlineService kwargs for a DockerResources, restart backoff turns into a deploy restart_policy"""
+    if resources is None:
+        return {}
+    kwargs = {key: getattr(resources, key) for key in ("cpus", "mem_limit", "mem_reservation", "cpuset", "shm_size")
+              if getattr(resources, key) is not None}
+    if resources.ulimits:
+        kwargs["ulimits"] = dict(resources.ulimits)
+    if resources.restart_max_attempts is not None:
+        kwargs["restart"] = "on-failure:%d" % resources.restart_max_attempts
+    restart_policy = {"condition": "on-failure"}
+    for key, value in (("delay", resources.restart_delay), ("max_attempts", resources.restart_max_attempts),
+                       ("window", resources.restart_window)):
+        if value is not None:
+            restart_policy[key] = value
+    if resources.restart_delay is not None or resources.restart_window is not None:
+        kwargs["deploy"] = {"restart_policy": restart_policy}
+    return kwargs
+
+
+def load_balancer_config_path(name):
+    return "volumes/nginx/%s.conf" % name
+
+
+def nginx_config(name, members, port, grpc=False):
+    """round robin over the replicas, grpc tiers are balanced per call instead of per connection"""
+    lines = ["upstream %s_backend {" % name]
+    lines.extend(["    server %s:%d max_fails=3 fail_timeout=5s;" % (member, port) for member in members])
+    lines.append("    keepalive 64;")
+    lines.append("}")
+    lines.append("server {")
+    if grpc:
+        lines.append("    listen %d http2;" % port)
+        lines.append("    location / {")
+        lines.append("        grpc_pass grpc://%s_backend;" % name)
+        lines.append("        grpc_next_upstream error timeout unavailable;")
+    else:
+        lines.append("    listen %d;" % port)
+        lines.append("    location / {")
+        lines.append("        proxy_pass http://%s_backend;" % name)
+        lines.append("        proxy_http_version 1.1;")
+        lines.append('        proxy_set_header Connection "";')
+        lines.append("        proxy_next_upstream error timeout http_502 http_503;")
+    lines.append("    }")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def new_healthcheck(test, interval="2s", timeout="3s", retries=30, start_period="5s"):
+    return {"test": [S(x) for x in test], "interval": interval, "timeout": timeout, "retries": retries,
+            "start_period": start_period}
+
+
+def tcp_healthcheck(port):
+    """a listening socket on port in /proc/net/tcp(6), needs only sh and grep, which busybox images have too"""
+    return new_healthcheck(["CMD-SHELL", "grep -qsi ':%04X [0-9A-F]*:0000 0A' /proc/net/tcp /proc/net/tcp6 || exit 1"
+                            % int(port)])
+
+
+def healthcheck_kwargs(test):
+    """OnlineService kwargs replacing the default healthcheck of the service kind with a DockerInfo test"""
+    return {"healthcheck": new_healthcheck(test)} if test else {}
+
+
 @define
 class OnlineService(BaseDefaultConfig):
     container_name: str
     image: str
     command: list = field()
-    environment: dict = field(init=False, default={})
-    ports: list = field(init=False, default=[])
-    depends_on: list = field(init=False, default=[])
-    volumes: list = field(init=False, default=[])
-    healthcheck: dict = field(init=False, default={})
-    restart: Literal['on-failure', 'always'] = field(init=False, default="on-failure")
+    environment: dict = field(init=False, factory=dict)
+    ports: list = ConfigField(init=False, factory=list, dump=dump_ports)
+    expose: list = field(init=False, factory=list)
+    depends_on: list = ConfigField(init=False, factory=list, dump=dump_depends_on)
+    volumes: list = field(init=False, factory=list)
+    healthcheck: dict = field(init=False, factory=dict)
+    restart: str = field(init=False, default="on-failure")
+    cpus: float = field(init=False, default=None)
+    mem_limit: str = field(init=False, default=None)
+    mem_reservation: str = field(init=False, default=None)
+    cpuset: str = field(init=False, default=None)
+    shm_size: str = field(init=False, default=None)
+    ulimits: dict = field(init=False, factory=dict)
+    deploy: dict = field(init=False, factory=dict)
     build: DockerBuildInfo = field(init=False, default=None)
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         if "container_name" not in kwargs:
             raise ValueError("no container_name configure")
-        if "restart" not in kwargs:
-            self.dict_data["restart"] = self.restart
         if "image" not in kwargs:
             self.build = DockerBuildInfo()
-            self.dict_data["build"] = self.build.to_dict()
-        if "ports" in kwargs:
-            self.dict_data["ports"] = [S("%d:%d" % (port, port)) for port in self.ports]
 
     def add_env(self, key, value):
         self.environment[key] = value
-        if "environment" not in self.dict_data:
-            self.dict_data["environment"] = self.environment
 
 
 @define
 class OnlineDockerCompose(BaseDefaultConfig):
     version: Literal['3.5'] = field(init=False, default='3.5')
-    services: dict = field(init=False, default={})
-    networks: dict = field(init=False, default={"default": {"name": "recommend"}})
+    services: dict = field(init=False, factory=dict)
+    networks: dict = field(init=False, factory=lambda: {"default": {"name": "recommend"}})
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.dict_data["version"] = self.version
-        self.dict_data["networks"] = self.networks
 
-    def to_dict(self):
-        if self.services:
-            self.dict_data["services"] = {key: value.to_dict() for key, value in self.services.items()}
-        return self.dict_data
+    def gate_depends_on(self):
+        """turn depends_on into conditions, services with a healthcheck must be healthy before dependents start"""
+        for service in self.services.values():
+            if not service.depends_on or isinstance(service.depends_on, dict):
+                continue
+            service.depends_on = {
+                name: {"condition": "service_healthy" if self.services[name].healthcheck else "service_started"}
+                for name in service.depends_on if name in self.services}
 
-    def add_service(self, name, container_name, **kwargs):
+    def add_service(self, name, container_name, kind=None, **kwargs):
         if not name:
             return
+        kind = kind or name
         service_kwargs = dict()
         service_kwargs.update(kwargs)
-        if name == "recommend":
+        if kind == "recommend":
             service_kwargs["ports"] = kwargs.setdefault("ports", [8081])
             service_kwargs["image"] = kwargs.setdefault("image", "dmetasoul/recommend-service-11:1.0")
             service_kwargs["command"] = kwargs.setdefault("command", "java -jar recommend-service-1.0-SNAPSHOT.jar")
             service_kwargs["depends_on"] = kwargs.setdefault("depends_on", ["consul"])
-        if name == "consul":
+        if kind == "consul":
             service_kwargs["ports"] = kwargs.setdefault("ports", [8500, 8600, 8300])
             service_kwargs["environment"] = {'CONSUL_LOCAL_CONFIG': r"{\"skip_leave_on_interrupt\": true}"}
             service_kwargs["environment"].update(kwargs.setdefault("environment", {}))
             service_kwargs["image"] = kwargs.setdefault("image", "consul:1.13.1")
             service_kwargs["command"] = kwargs.setdefault("command",
                                                           "consul agent -server -bootstrap-expect 1 -data-dir=/consul/data -bind=127.0.0.1 -client=0.0.0.0 -ui")
-        if str(name).startswith("model"):
+            service_kwargs["healthcheck"] = kwargs.setdefault("healthcheck", new_healthcheck(["CMD", "consul", "members"]))
+        if str(kind).startswith("model"):
             service_kwargs["ports"] = kwargs.setdefault("ports", [50000])
             service_kwargs["image"] = kwargs.setdefault("image", "swr.cn-southwest-2.myhuaweicloud.com/dmetasoul-public/metaspore-serving-release:cpu-v1.0.1")
             service_kwargs["command"] = kwargs.setdefault("command", "/opt/metaspore-serving/bin/metaspore-serving-bin -grpc_listen_port 50000 -init_load_path /data/models")
             service_kwargs["volumes"] = kwargs.setdefault("volumes", ["${DOCKER_VOLUME_DIRECTORY:-.}/volumes/serving_models:/data/models"])
-        if str(name).startswith("mongo"):
+            service_kwargs["healthcheck"] = kwargs.setdefault("healthcheck", tcp_healthcheck(service_kwargs["ports"][0]))
+        if str(kind).startswith("mongo"):
             service_kwargs["ports"] = kwargs.setdefault("ports", [27017])
             service_kwargs["image"] = kwargs.setdefault("image", "mongo:6.0.1")
             service_kwargs["restart"] = kwargs.setdefault("restart", "always")
-        if str(name).startswith("redis"):
+            service_kwargs["healthcheck"] = kwargs.setdefault("healthcheck", new_healthcheck(
+                ["CMD", "mongosh", "--quiet", "--eval", "db.adminCommand('ping').ok"]))
+        if str(kind).startswith("redis"):
             service_kwargs["ports"] = kwargs.setdefault("ports", [6379])
             service_kwargs["image"] = kwargs.setdefault("image", "redis:7.0.4")
             service_kwargs["restart"] = kwargs.setdefault("restart", "always")
-        if str(name).startswith("mysql"):
+            service_kwargs["healthcheck"] = kwargs.setdefault("healthcheck", new_healthcheck(["CMD", "redis-cli", "ping"]))
+        if str(kind).startswith("mysql"):
             service_kwargs["ports"] = kwargs.setdefault("ports", [3306])
             service_kwargs["image"] = kwargs.setdefault("image", "mysql:8.0.30")
             service_kwargs["restart"] = kwargs.setdefault("restart", "always")
-        if name == "etcd":
+            service_kwargs["healthcheck"] = kwargs.setdefault("healthcheck", new_healthcheck(
+                ["CMD", "mysqladmin", "ping", "-h", "localhost"]))
+        if kind == "etcd":
+            service_kwargs["expose"] = kwargs.setdefault("expose", [2379])
             service_kwargs["volumes"] = kwargs.setdefault("volumes", ["${DOCKER_VOLUME_DIRECTORY:-.}/volumes/etcd:/etcd"])
             service_kwargs["environment"] = {'ETCD_AUTO_COMPACTION_MODE': "revision", "ETCD_AUTO_COMPACTION_RETENTION": 1000,
                                "ETCD_QUOTA_BACKEND_BYTES": 4294967296}
@@ -118,7 +204,8 @@ class OnlineDockerCompose(BaseDefaultConfig):
             service_kwargs["image"] = kwargs.setdefault("image", "quay.io/coreos/etcd:v3.5.0")
             service_kwargs["command"] = kwargs.setdefault("command",
                                                           "etcd -advertise-client-urls=http://127.0.0.1:2379 -listen-client-urls http://0.0.0.0:2379 --data-dir /etcd")
-        if name == "minio":
+        if kind == "minio":
+            service_kwargs["expose"] = kwargs.setdefault("expose", [9000])
             service_kwargs["volumes"] = kwargs.setdefault("volumes", ["${DOCKER_VOLUME_DIRECTORY:-.}/volumes/minio:/minio_data"])
             service_kwargs["environment"] = {'MINIO_ACCESS_KEY': "minioadmin", "MINIO_SECRET_KEY": "minioadmin"}
             service_kwargs["environment"].update(kwargs.setdefault("environment", {}))
@@ -128,7 +215,12 @@ class OnlineDockerCompose(BaseDefaultConfig):
             service_kwargs["healthcheck"] = kwargs.setdefault("healthcheck",
                                {"test": [S("CMD"), S("curl"), S("-f"), S("http://localhost:9000/minio/health/live")],
                                "interval": "30s", "timeout": "20s", "retries": 3})
-        if str(name).startswith("milvus"):
+        if kind == "nginx":
+            service_kwargs["image"] = kwargs.setdefault("image", "nginx:1.23.1")
+            service_kwargs["volumes"] = kwargs.setdefault("volumes", [
+                "${DOCKER_VOLUME_DIRECTORY:-.}/%s:/etc/nginx/conf.d/default.conf:ro" % load_balancer_config_path(name)])
+            service_kwargs["healthcheck"] = kwargs.setdefault("healthcheck", tcp_healthcheck(service_kwargs["ports"][0]))
+        if str(kind).startswith("milvus"):
             service_kwargs["ports"] = kwargs.setdefault("ports", [19530])
             service_kwargs["environment"] = {'ETCD_ENDPOINTS': "etcd:2379", "MINIO_ADDRESS": "minio:9000"}
             service_kwargs["environment"].update(kwargs.setdefault("environment", {}))
@@ -138,14 +230,37 @@ class OnlineDockerCompose(BaseDefaultConfig):
             service_kwargs["volumes"] = kwargs.setdefault("volumes",
                                                           ["${DOCKER_VOLUME_DIRECTORY:-.}/volumes/milvus:/var/lib/milvus"])
             service_kwargs["depends_on"] = kwargs.setdefault("depends_on", ["etcd", "minio"])
+            service_kwargs["healthcheck"] = kwargs.setdefault("healthcheck", new_healthcheck(
+                ["CMD", "curl", "-f", "http://localhost:9091/healthz"], start_period="30s"))
         if "depends_on" in service_kwargs:
             for depend in service_kwargs["depends_on"]:
                 if depend not in self.services:
                     self.add_service(depend, "contain_%s_service" % depend)
-            service_kwargs["depends_on"] = [S(x) for x in service_kwargs["depends_on"]]
         service_kwargs["container_name"] = container_name
         self.services[name] = OnlineService(**service_kwargs)
 
+    def add_replicated_service(self, name, container_name, replicas, **kwargs):
+        """
+        add replicas <name>_1..<name>_N only reachable inside the compose network and an nginx load balancer
+        named <name> publishing the ports, so clients keep addressing the tier by its service name.
+        container_name is formatted with the service name of every container.
+        """
+        if not str(name).startswith("recommend") and not str(name).startswith("model"):
+            raise ValueError("replicas only support recommend and model services!")
+        members = list()
+        for index in range(1, replicas + 1):
+            member = "%s_%d" % (name, index)
+            member_kwargs = dict(kwargs)
+            member_kwargs["environment"] = dict(kwargs.get("environment") or {})
+            self.add_service(member, container_name % member, kind=name, **member_kwargs)
+            service = self.services[member]
+            service.expose = [S(str(port)) for port in service.ports]
+            service.ports = []
+            members.append(member)
+        port = int(self.services[members[0]].expose[0])
+        self.add_service(name, container_name % name, kind="nginx", ports=[port], depends_on=members)
+        return members
+
 
 if __name__ == '__main__':
     online = OnlineDockerCompose()
@@ -156,4 +271,5 @@ if __name__ == '__main__':
         "MONGO_INITDB_ROOT_PASSWORD": "example"
     })
     online.add_service("milvus", "milvus-service")
+    online.gate_depends_on()
     print(DumpToYaml(online))
@@ -0,0 +1,231 @@
+#
+# Copyright 2022 DMetaSoul
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+
+
+# field action funcs whose feature columns are fully declared by fields, algoColumns and output
+DECLARED_INPUT_FUNCS = {"typeTransform", "splitRecentIds", "recentWeight", "randomGenerator", "setValue",
+                        "toItemScore", "recallCollectItem", "concatField", "rankCollectItem", "predictScore",
+                        "predictEmbedding", "milvusSearch"}
+
+
+def split_ref(ref):
+    table, _, column = str(ref).partition(".")
+    if not column:
+        return None, table
+    return table, column
+
+
+def get_column_name(column):
+    return next(iter(column.keys())) if isinstance(column, dict) else column
+
+
+def algo_transform_required_columns(algo_transform):
+    """columns an algoTransform reads from its features, None if it can not be decided"""
+    produced = set()
+    required = set()
+    for action in algo_transform.fieldActions or []:
+        if action.func not in DECLARED_INPUT_FUNCS:
+            return None
+        produced.update(action.names or [])
+        required.update(action.fields or [])
+    algo_columns = set()
+    for action in algo_transform.fieldActions or []:
+        for column_info in action.algoColumns or []:
+            for names in column_info.values():
+                algo_columns.update(names)
+    required.update(algo_columns - produced)
+    required.update(set(algo_transform.output or []) - produced)
+    return required
+
+
+def feature_required_columns(feature_config):
+    """map feature name to the set of its output columns read downstream, None means keep all"""
+    features = {item.name: item for item in feature_config.feature}
+    required = {name: set() for name in features}
+    consumed = set()
+    for algo_transform in feature_config.algoTransform:
+        columns = algo_transform_required_columns(algo_transform)
+        for name in algo_transform.feature or []:
+            if name not in required:
+                continue
+            consumed.add(name)
+            if columns is None or required[name] is None:
+                required[name] = None
+            else:
+                required[name].update(columns)
+    for feature in reversed(feature_config.feature):
+        for table in feature.depend or []:
+            if table not in features:
+                continue
+            consumed.add(table)
+            if required[table] is None:
+                continue
+            for ref in feature.select or []:
+                ref_table, column = split_ref(ref)
+                if ref_table == table:
+                    required[table].add(column)
+                elif ref_table is None:
+                    required[table] = None
+                    break
+            if required[table] is None:
+                continue
+            for condition in feature.condition or []:
+                for ref in (condition.left, condition.right):
+                    ref_table, column = split_ref(ref)
+                    if ref_table == table:
+                        required[table].add(column)
+    for name in features:
+        if name not in consumed:
+            required[name] = None
+    return required
+
+
+def prune_feature_select(feature, columns):
+    if columns is None:
+        return
+    select = [ref for ref in feature.select if split_ref(ref)[1] in columns]
+    if select:
+        feature.select = select
+
+
+def prune_source_table_columns(feature_config):
+    tables = {item.name: item for item in feature_config.sourceTable}
+    required = dict()
+    for feature in feature_config.feature:
+        for table in feature.depend or []:
+            if table not in tables or required.get(table, set()) is None:
+                continue
+            columns = required.setdefault(table, set())
+            for ref in feature.select or []:
+                ref_table, column = split_ref(ref)
+                if ref_table is None:
+                    required[table] = None
+                    break
+                if ref_table == table:
+                    columns.add(column)
+            if required[table] is None:
+                continue
+            for condition in feature.condition or []:
+                for ref in (condition.left, condition.right):
+                    ref_table, column = split_ref(ref)
+                    if ref_table == table:
+                        columns.add(column)
+    for name, columns in required.items():
+        if not columns:
+            continue
+        source_table = tables[name]
+        pruned = [column for column in source_table.columns if get_column_name(column) in columns]
+        if pruned:
+            source_table.columns = pruned
+
+
+def prune_unused_columns(feature_config):
+    """narrow feature selects and sourceTable columns to the columns consumed downstream"""
+    required = feature_required_columns(feature_config)
+    for feature in feature_config.feature:
+        prune_feature_select(feature, required.get(feature.name))
+    prune_source_table_columns(feature_config)
+    return feature_config
+
+
+def rename_ref(ref, renames):
+    table, column = split_ref(ref)
+    if table is not None and table in renames:
+        return "%s.%s" % (renames[table], column)
+    return ref
+
+
+def rename_refs(feature_config, recommend_config, renames):
+    for feature in feature_config.feature:
+        feature.depend = [renames.get(name, name) for name in feature.depend]
+        feature.select = [rename_ref(ref, renames) for ref in feature.select]
+        for condition in feature.condition or []:
+            condition.left = rename_ref(condition.left, renames)
+            condition.right = rename_ref(condition.right, renames)
+    for algo_transform in feature_config.algoTransform:
+        algo_transform.feature = [renames.get(name, name) for name in algo_transform.feature or []]
+        algo_transform.algoTransform = [renames.get(name, name) for name in algo_transform.algoTransform or []]
+    if recommend_config is not None:
+        for service in recommend_config.services:
+            service.tasks = [renames.get(name, name) for name in service.tasks or []]
+
+
+def node_signature(node, *excludes):
+    data = node.to_dict()
+    for key in excludes:
+        data.pop(key, None)
+    return json.dumps(data, sort_keys=True, default=str)
+
+
+def merge_duplicate_nodes(nodes, signature, merge=None):
+    """drop nodes whose signature repeats an earlier one, return {dropped name: kept name}"""
+    kept = dict()
+    renames = dict()
+    result = list()
+    for node in nodes:
+        key = signature(node)
+        if key in kept:
+            renames[node.name] = kept[key].name
+            if merge is not None:
+                merge(kept[key], node)
+            continue
+        kept[key] = node
+        result.append(node)
+    nodes[:] = result
+    return renames
+
+
+def merge_feature_select(kept, dropped):
+    selected = set(kept.select)
+    kept.select.extend([ref for ref in dropped.select if ref not in selected])
+
+
+def dedup_field_actions(algo_transform):
+    seen = set()
+    actions = list()
+    for action in algo_transform.fieldActions or []:
+        key = json.dumps(action.to_dict(), sort_keys=True, default=str)
+        if key in seen:
+            continue
+        seen.add(key)
+        actions.append(action)
+    algo_transform.fieldActions = actions
+
+
+def merge_common_nodes(feature_config, recommend_config=None):
+    """
+    share structurally identical sourceTables, features and algoTransforms between their consumers.
+    features with the same from/condition/filters are merged into one node selecting the union of columns.
+    rank features are not merged across rank models: each joins the candidate table the recommend service
+    registers under its own service name (rank_<name>), so their conditions differ and one shared node
+    could not serve both services. only the sourceTables and cross feature actions under them are shared.
+    """
+    renames = merge_duplicate_nodes(feature_config.sourceTable, lambda node: node_signature(node, "name"))
+    for algo_transform in feature_config.algoTransform:
+        dedup_field_actions(algo_transform)
+    while True:
+        if renames:
+            rename_refs(feature_config, recommend_config, renames)
+        renames = merge_duplicate_nodes(feature_config.feature, lambda node: node_signature(node, "name", "select"),
+                                        merge_feature_select)
+        if renames:
+            rename_refs(feature_config, recommend_config, renames)
+        algo_renames = merge_duplicate_nodes(feature_config.algoTransform, lambda node: node_signature(node, "name"))
+        if not renames and not algo_renames:
+            break
+        renames = algo_renames
+    return feature_config
@@ -0,0 +1,96 @@
+#
+# Copyright 2022 DMetaSoul
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from latency_planner import layer_steps
+
+SKIP_FALLBACK = "skip"
+
+
+def resolve_fallback(stage, tier, policy, services, pop_service):
+    """
+    (mode, steps) run instead of stage: substitute runs steps on the stage input,
+    passThrough returns the input, e.g. recall order when rank is skipped, drop returns no candidates.
+    """
+    target = policy.fallback
+    if target is None:
+        if tier == "rank":
+            return "passThrough", []
+        if not pop_service:
+            raise ValueError("fallback of %s needs a random_model recall or a fallback target!" % stage)
+        target = pop_service
+    if target == SKIP_FALLBACK:
+        return ("passThrough" if tier == "rank" else "drop"), []
+    if target not in services and "recall_%s" % target in services:
+        target = "recall_%s" % target
+    if target not in services:
+        raise ValueError("fallback target %s of %s is not a service!" % (policy.fallback, stage))
+    if target == stage:
+        raise ValueError("fallback target of %s must not be itself!" % stage)
+    return "substitute", [target]
+
+
+def fallback_option(stage, tier, policy, service, services, pop_service):
+    timeout = policy.timeout_ms or (service.options or {}).get("timeout")
+    if not timeout or timeout <= 0:
+        raise ValueError("fallback of %s needs timeout_ms or a latency_budget!" % stage)
+    if policy.failure_threshold <= 0 or policy.open_ms <= 0 or policy.half_open_calls <= 0:
+        raise ValueError("fallback of %s circuit breaker thresholds must be positive!" % stage)
+    mode, steps = resolve_fallback(stage, tier, policy, services, pop_service)
+    return {"timeout": int(timeout), "failureThreshold": policy.failure_threshold, "openMs": policy.open_ms,
+            "halfOpenCalls": policy.half_open_calls, "onFallback": mode, "fallback": steps}
+
+
+def apply_fallback_policies(server_config, fallbacks, pop_model=None):
+    """
+    write chain options fallbacks: {step: {timeout, failureThreshold, openMs, halfOpenCalls, onFallback, fallback}}
+    into every experiment and scene chain running a guarded service.
+    a recall or rank key guards every service of that layer but the pop recall they fall back to.
+    return the options per guarded service.
+    """
+    recommend_config = server_config.recommend_service
+    services = {item.name: item for item in recommend_config.services}
+    tiers = dict()
+    for tier in ("recall", "rank"):
+        tiers.update({name: tier for name in layer_steps(recommend_config, tier)[1]})
+    pop_service = "recall_%s" % pop_model if pop_model and "recall_%s" % pop_model in services else None
+    options = dict()
+    for key, policy in fallbacks.items():
+        stages = [name for name, tier in tiers.items() if tier == key and name != pop_service] \
+            if key in ("recall", "rank") else [key]
+        for stage in stages:
+            if stage not in services:
+                raise ValueError("fallback policy %s is not a service!" % stage)
+            if key not in ("recall", "rank") or stage not in options:
+                options[stage] = fallback_option(stage, tiers.get(stage), policy, services[stage], services,
+                                                 pop_service)
+    for stage, option in options.items():
+        # the pop recall is the last resort of the others, it must not fall back to a guarded stage itself
+        if any(target in options and options[target]["fallback"] for target in option["fallback"]):
+            raise ValueError("fallback of %s must not chain into another guarded fallback!" % stage)
+    chains = [chain for item in list(recommend_config.experiments) + list(recommend_config.scenes)
+              for chain in item.chains or []]
+    for chain in chains:
+        steps = list(chain.when or []) + list(chain.then or [])
+        for step in steps:
+            if step not in options:
+                continue
+            # copied per chain, shared objects would be dumped as yaml anchors
+            option = dict(options[step], fallback=[target for target in options[step]["fallback"]
+                                                   if target not in steps])
+            if option["onFallback"] == "substitute" and not option["fallback"]:
+                # the chain already runs the fallback target, e.g. recall_pop merged beside the other recalls
+                option["onFallback"] = "passThrough" if tiers.get(step) == "rank" else "drop"
+            chain.options.setdefault("fallbacks", dict())[step] = option
+    return options
@@ -0,0 +1,327 @@
+#
+# Copyright 2022 DMetaSoul
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import io
+import re
+import shlex
+
+from attrs import define, field
+from ruamel.yaml.scalarstring import LiteralScalarString
+
+from common import NewYamlDumper
+
+DNS_LABEL = re.compile(r"^[a-z0-9]([-a-z0-9]*[a-z0-9])?$")
+QUANTITY = re.compile(r"^[0-9]+(\.[0-9]+)?(m|Ki|Mi|Gi|Ti|k|M|G|T)?$")
+COMPOSE_UNITS = {"b": "", "k": "Ki", "m": "Mi", "g": "Gi"}
+COMPOSE_VARIABLE = re.compile(r"\$\{[^}]*\}")
+
+CONFIG_MOUNT_PATH = "/config"
+CONFIG_FILE_NAME = "recommend-config.yaml"
+
+
+@define
+class K8sOptions(object):
+    namespace: str = "recommend"
+    # consul or configmap, configmap mounts the service config into recommend instead of pushing it to consul
+    config_store: str = "consul"
+    min_replicas: int = 1
+    max_replicas: int = 10
+    cpu_utilization: int = 70
+    # cpu request of autoscaled deployments without cpus, the cpu utilization target is relative to it
+    default_cpu_request: str = "500m"
+    # a pods metric served by a custom metrics adapter, e.g. recommend_request_latency_p99_ms
+    latency_metric: str = None
+    latency_target: str = "100"
+    volume_size: str = "10Gi"
+    # access mode of the claims of autoscaled or replicated deployments, their pods may run on different nodes
+    shared_access_mode: str = "ReadWriteMany"
+    recommend_service_type: str = "ClusterIP"
+    autoscale: list = field(factory=lambda: ["recommend", "model"])
+
+
+def k8s_name(name):
+    return str(name).lower().replace("_", "-").replace(".", "-")
+
+
+def k8s_quantity(value):
+    """docker compose memory (512m, 2g) to a kubernetes quantity (512Mi, 2Gi)"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    unit = value[-1:].lower()
+    if unit in COMPOSE_UNITS and value[:-1].isdigit():
+        return "%s%s" % (value[:-1], COMPOSE_UNITS[unit])
+    return value
+
+
+def labels_of(name):
+    return {"app": k8s_name(name)}
+
+
+def container_command(command):
+    if not command:
+        return None
+    if isinstance(command, str):
+        return shlex.split(command)
+    return [str(x) for x in command]
+
+
+def container_env(environment, service_names):
+    env = list()
+    for key, value in (environment or {}).items():
+        if str(key).endswith("_HOST") and value in service_names:
+            value = k8s_name(value)
+        env.append({"name": str(key), "value": str(value)})
+    return env
+
+
+def service_ports(service):
+    """published and expose-only compose ports, both are reachable in cluster through the k8s Service"""
+    return list(service.ports or []) + [port for port in service.expose or [] if port not in (service.ports or [])]
+
+
+def readiness_probe(service):
+    test = [str(x) for x in (service.healthcheck or {}).get("test", [])]
+    if test and test[0] == "CMD":
+        handler = {"exec": {"command": test[1:]}}
+    elif service.ports:
+        handler = {"tcpSocket": {"port": int(service.ports[0])}}
+    elif test and test[0] == "CMD-SHELL":
+        handler = {"exec": {"command": ["sh", "-c", test[1]]}}
+    else:
+        return None
+    handler.update({"initialDelaySeconds": 5, "periodSeconds": 5, "timeoutSeconds": 3, "failureThreshold": 6})
+    return handler
+
+
+def container_resources(service, default_cpu=None):
+    requests = dict()
+    limits = dict()
+    if service.cpus:
+        requests["cpu"] = str(service.cpus)
+        limits["cpu"] = str(service.cpus)
+    elif default_cpu:
+        requests["cpu"] = str(default_cpu)
+    if service.mem_reservation:
+        requests["memory"] = k8s_quantity(service.mem_reservation)
+    if service.mem_limit:
+        limits["memory"] = k8s_quantity(service.mem_limit)
+        requests.setdefault("memory", limits["memory"])
+    resources = dict()
+    if requests:
+        resources["requests"] = requests
+    if limits:
+        resources["limits"] = limits
+    return resources
+
+
+def volume_mounts(name, service):
+    mounts = list()
+    claims = list()
+    for index, volume in enumerate(service.volumes or []):
+        # ${DOCKER_VOLUME_DIRECTORY:-.} holds a colon of its own, only the host side has variables
+        parts = COMPOSE_VARIABLE.sub("", str(volume)).split(":")
+        if len(parts) < 2:
+            continue
+        claim = "%s-volume-%d" % (k8s_name(name), index)
+        mount = {"name": claim, "mountPath": parts[1]}
+        if len(parts) > 2 and parts[2] == "ro":
+            mount["readOnly"] = True
+        mounts.append(mount)
+        claims.append(claim)
+    return mounts, claims
+
+
+def new_pvc(claim, namespace, size, access_mode="ReadWriteOnce"):
+    return {"apiVersion": "v1", "kind": "PersistentVolumeClaim",
+            "metadata": {"name": claim, "namespace": namespace},
+            "spec": {"accessModes": [access_mode], "resources": {"requests": {"storage": size}}}}
+
+
+def new_deployment(name, service, namespace, replicas, service_names, config_map=None, default_cpu=None):
+    container = {"name": k8s_name(name), "image": service.image}
+    command = container_command(service.command)
+    if command:
+        container["command"] = command
+    env = container_env(service.environment, service_names)
+    ports = [{"containerPort": int(port)} for port in service_ports(service)]
+    if ports:
+        container["ports"] = ports
+    probe = readiness_probe(service)
+    if probe:
+        container["readinessProbe"] = probe
+    resources = container_resources(service, default_cpu)
+    if resources:
+        container["resources"] = resources
+    mounts, claims = volume_mounts(name, service)
+    volumes = [{"name": claim, "persistentVolumeClaim": {"claimName": claim}} for claim in claims]
+    if config_map:
+        mounts.append({"name": "service-config", "mountPath": CONFIG_MOUNT_PATH, "readOnly": True})
+        volumes.append({"name": "service-config", "configMap": {"name": config_map}})
+        env.append({"name": "SPRING_CONFIG_IMPORT",
+                    "value": "optional:file:%s/%s" % (CONFIG_MOUNT_PATH, CONFIG_FILE_NAME)})
+        env.append({"name": "SPRING_CLOUD_CONSUL_CONFIG_ENABLED", "value": "false"})
+    if env:
+        container["env"] = env
+    if mounts:
+        container["volumeMounts"] = mounts
+    pod_spec = {"containers": [container]}
+    if volumes:
+        pod_spec["volumes"] = volumes
+    if service.shm_size:
+        pod_spec.setdefault("volumes", []).append(
+            {"name": "dshm", "emptyDir": {"medium": "Memory", "sizeLimit": k8s_quantity(service.shm_size)}})
+        container.setdefault("volumeMounts", []).append({"name": "dshm", "mountPath": "/dev/shm"})
+    return {"apiVersion": "apps/v1", "kind": "Deployment",
+            "metadata": {"name": k8s_name(name), "namespace": namespace, "labels": labels_of(name)},
+            "spec": {"replicas": replicas, "selector": {"matchLabels": labels_of(name)},
+                     "template": {"metadata": {"labels": labels_of(name)}, "spec": pod_spec}}}
+
+
+def new_service(name, service, namespace, service_type="ClusterIP"):
+    return {"apiVersion": "v1", "kind": "Service",
+            "metadata": {"name": k8s_name(name), "namespace": namespace, "labels": labels_of(name)},
+            "spec": {"type": service_type, "selector": labels_of(name),
+                     "ports": [{"name": "port-%d" % int(port), "port": int(port), "targetPort": int(port)}
+                               for port in service_ports(service)]}}
+
+
+def new_hpa(name, namespace, options, replicas, cpu_request=True):
+    """cpu utilization is only computable against a cpu request, otherwise scale on the latency metric alone"""
+    metrics = list()
+    if cpu_request:
+        metrics.append({"type": "Resource", "resource": {"name": "cpu", "target": {
+            "type": "Utilization", "averageUtilization": options.cpu_utilization}}})
+    if options.latency_metric:
+        metrics.append({"type": "Pods", "pods": {"metric": {"name": options.latency_metric}, "target": {
+            "type": "AverageValue", "averageValue": str(options.latency_target)}}})
+    return {"apiVersion": "autoscaling/v2", "kind": "HorizontalPodAutoscaler",
+            "metadata": {"name": k8s_name(name), "namespace": namespace},
+            "spec": {"scaleTargetRef": {"apiVersion": "apps/v1", "kind": "Deployment", "name": k8s_name(name)},
+                     "minReplicas": max(options.min_replicas, 1),
+                     "maxReplicas": max(options.max_replicas, replicas, options.min_replicas),
+                     "metrics": metrics}}
+
+
+def new_config_map(name, namespace, server_config_yaml):
+    return {"apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": name, "namespace": namespace},
+            "data": {CONFIG_FILE_NAME: LiteralScalarString(server_config_yaml)}}
+
+
+def build_k8s_manifests(online_docker_compose, replicas=None, server_config_yaml=None, options=None):
+    """
+    Deployment, Service, PersistentVolumeClaim and HorizontalPodAutoscaler manifests for every compose service.
+    replicas maps service name to the deployment replicas, compose level load balancers are not needed here.
+    """
+    options = options or K8sOptions()
+    if options.config_store not in ("consul", "configmap"):
+        raise ValueError("config_store must be consul or configmap!")
+    replicas = replicas or {}
+    services = dict(online_docker_compose.services)
+    config_map = None
+    manifests = list()
+    if options.config_store == "configmap":
+        if server_config_yaml is None:
+            raise ValueError("config_store configmap need the server config!")
+        services.pop("consul", None)
+        for service in services.values():
+            service.environment = {key: value for key, value in service.environment.items()
+                                   if key not in ("CONSUL_HOST", "CONSUL_PORT")}
+        config_map = "recommend-config"
+        manifests.append(new_config_map(config_map, options.namespace, server_config_yaml))
+    for name, service in services.items():
+        autoscaled = any(name == tier or str(name).startswith(tier) for tier in options.autoscale)
+        _, claims = volume_mounts(name, service)
+        access_mode = options.shared_access_mode if autoscaled or replicas.get(name, 1) > 1 else "ReadWriteOnce"
+        manifests.extend([new_pvc(claim, options.namespace, options.volume_size, access_mode) for claim in claims])
+        # cpu utilization is relative to the request, autoscaled deployments without cpus get the default one
+        default_cpu = options.default_cpu_request if autoscaled else None
+        manifests.append(new_deployment(name, service, options.namespace, replicas.get(name, 1), services,
+                                        config_map if name == "recommend" else None, default_cpu))
+        if service_ports(service):
+            manifests.append(new_service(name, service, options.namespace,
+                                         options.recommend_service_type if name == "recommend" else "ClusterIP"))
+        if autoscaled:
+            manifests.append(new_hpa(name, options.namespace, options, replicas.get(name, 1),
+                                     bool(service.cpus or default_cpu)))
+    return manifests
+
+
+def validate_manifests(manifests):
+    """offline checks of the generated manifests, return a list of error messages"""
+    errors = list()
+    names = dict()
+    for manifest in manifests:
+        kind = manifest.get("kind")
+        name = manifest.get("metadata", {}).get("name")
+        if not manifest.get("apiVersion") or not kind:
+            errors.append("manifest without apiVersion or kind: %s" % name)
+            continue
+        if not name or not DNS_LABEL.match(name) or len(name) > 63:
+            errors.append("%s name %s is not a valid dns label" % (kind, name))
+        if (kind, name) in names:
+            errors.append("duplicate %s %s" % (kind, name))
+        names[(kind, name)] = manifest
+    deployments = {name: manifest for (kind, name), manifest in names.items() if kind == "Deployment"}
+    for (kind, name), manifest in names.items():
+        spec = manifest.get("spec", {})
+        if kind == "Deployment":
+            template_labels = spec["template"]["metadata"]["labels"]
+            if any(template_labels.get(key) != value for key, value in spec["selector"]["matchLabels"].items()):
+                errors.append("Deployment %s selector does not match its pod labels" % name)
+            for container in spec["template"]["spec"]["containers"]:
+                if not container.get("image"):
+                    errors.append("Deployment %s container %s has no image" % (name, container.get("name")))
+                for port in container.get("ports", []):
+                    if not 0 < port["containerPort"] < 65536:
+                        errors.append("Deployment %s port %s out of range" % (name, port["containerPort"]))
+                for bound in container.get("resources", {}).values():
+                    for resource, value in bound.items():
+                        if not QUANTITY.match(str(value)):
+                            errors.append("Deployment %s %s quantity %s is invalid" % (name, resource, value))
+                for mount in container.get("volumeMounts", []):
+                    if not str(mount.get("mountPath", "")).startswith("/"):
+                        errors.append("Deployment %s mount path %s is not absolute" % (name, mount.get("mountPath")))
+                for volume in spec["template"]["spec"].get("volumes", []):
+                    claim = volume.get("persistentVolumeClaim", {}).get("claimName")
+                    if claim and ("PersistentVolumeClaim", claim) not in names:
+                        errors.append("Deployment %s mounts missing claim %s" % (name, claim))
+                    config_map = volume.get("configMap", {}).get("name")
+                    if config_map and ("ConfigMap", config_map) not in names:
+                        errors.append("Deployment %s mounts missing config map %s" % (name, config_map))
+        elif kind == "Service":
+            selector = spec.get("selector", {})
+            if not any(all(deployment["spec"]["template"]["metadata"]["labels"].get(key) == value
+                           for key, value in selector.items()) for deployment in deployments.values()):
+                errors.append("Service %s selects no deployment" % name)
+        elif kind == "HorizontalPodAutoscaler":
+            target = spec.get("scaleTargetRef", {}).get("name")
+            if target not in deployments:
+                errors.append("HorizontalPodAutoscaler %s targets missing deployment %s" % (name, target))
+            if not spec.get("metrics"):
+                errors.append("HorizontalPodAutoscaler %s has no metric, set cpus or a latency metric" % name)
+            if spec.get("minReplicas", 1) > spec.get("maxReplicas", 0):
+                errors.append("HorizontalPodAutoscaler %s minReplicas > maxReplicas" % name)
+    return errors
+
+
+def dump_k8s_manifests(manifests, stream=None):
+    yaml = NewYamlDumper()
+    if stream is not None:
+        yaml.dump_all(manifests, stream)
+        return None
+    buffer = io.StringIO()
+    yaml.dump_all(manifests, buffer)
+    return buffer.getvalue()
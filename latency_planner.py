@@ -0,0 +1,190 @@
+#
+# Copyright 2022 DMetaSoul
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import math
+
+from online_estimator import PipelineCostModel
+
+
+def measured_stage_costs(stats):
+    """ReferenceExecutor.stats of {name: (total seconds, count)} as mean ms per stage"""
+    return {name: total * 1000.0 / count for name, (total, count) in stats.items() if count}
+
+
+def experiment_steps(experiment, services):
+    """services of the chains of an experiment, in chain order"""
+    steps = list()
+    for chain in experiment.chains or []:
+        steps.extend([step for step in list(chain.when or []) + list(chain.then or [])
+                      if step in services and step not in steps])
+    return steps
+
+
+def layer_steps(recommend_config, layer_name):
+    """experiments of a layer and the services their chains run"""
+    layer = next((item for item in recommend_config.layers if item.name == layer_name), None)
+    experiments = {item.name: item for item in recommend_config.experiments}
+    services = {item.name for item in recommend_config.services}
+    names = [item.name for item in layer.experiments or []] if layer else []
+    steps = list()
+    for name in names:
+        steps.extend([step for step in experiment_steps(experiments[name], services) if step not in steps])
+    return names, steps
+
+
+def split_quotas(candidates, weights, min_quota=0):
+    """
+    every recall gets min_quota, the rest of the candidates is split by weight with the largest remainder method,
+    so the quotas sum to exactly candidates
+    """
+    if not weights:
+        return dict()
+    if min_quota * len(weights) > candidates:
+        raise ValueError("min quota %d of %d recalls exceeds %d rank candidates!" % (
+            min_quota, len(weights), candidates))
+    rest = candidates - min_quota * len(weights)
+    total_weight = sum(weights.values())
+    if total_weight <= 0:
+        weights = {name: 1.0 for name in weights}
+        total_weight = float(len(weights))
+    shares = {name: rest * weight / total_weight for name, weight in weights.items()}
+    quotas = {name: min_quota + int(math.floor(share)) for name, share in shares.items()}
+    left = candidates - sum(quotas.values())
+    for name in sorted(shares, key=lambda key: shares[key] - math.floor(shares[key]), reverse=True)[:left]:
+        quotas[name] += 1
+    return quotas
+
+
+class LatencyPlanner(object):
+    """
+    fit recall and rank into an end to end latency slo.
+    recall services run in parallel, rank scores every merged candidate, so the rank stage is
+    fixed ms + candidates * ms per candidate and the candidate budget is what the slo leaves for it.
+    """
+
+    def __init__(self, server_config, budget, profile=None):
+        self.server_config = server_config
+        self.budget = budget
+        self.cost_model = PipelineCostModel(server_config, profile)
+        self.stage_costs = budget.stage_costs or {}
+
+    def stage_cost(self, name):
+        """(fixed ms, ms per candidate) of a service"""
+        declared = self.stage_costs.get(name)
+        if declared is not None:
+            if isinstance(declared, (list, tuple)):
+                return float(declared[0]), float(declared[1]) if len(declared) > 1 else 0.0
+            return float(declared), 0.0
+        one = self.cost_model.service_cost(name, 1).latency_ms
+        many = self.cost_model.service_cost(name, 1001).latency_ms
+        per_row = max(0.0, (many - one) / 1000.0)
+        return max(0.0, one - per_row), per_row
+
+    def recall_weight(self, service_name):
+        weights = self.budget.recall_weights or {}
+        model_name = service_name[len("recall_"):] if service_name.startswith("recall_") else service_name
+        return float(weights.get(service_name, weights.get(model_name, 1.0)))
+
+    def plan(self):
+        recommend_config = self.server_config.recommend_service
+        recall_experiments, recall_services = layer_steps(recommend_config, "recall")
+        rank_experiments, rank_services = layer_steps(recommend_config, "rank")
+        if self.budget.slo_ms <= 0:
+            raise ValueError("latency slo must be positive!")
+        slo_ms = self.budget.slo_ms * (1.0 - self.budget.headroom)
+        recall_costs = {name: self.stage_cost(name)[0] for name in recall_services}
+        rank_costs = {name: self.stage_cost(name) for name in rank_services}
+        recall_ms = max(recall_costs.values() or [0.0])
+        rank_fixed_ms = max([fixed for fixed, _ in rank_costs.values()] or [0.0])
+        rank_row_ms = max([per_row for _, per_row in rank_costs.values()] or [0.0])
+        available_ms = slo_ms - recall_ms - rank_fixed_ms
+        if available_ms <= 0:
+            raise ValueError("latency slo %.1fms can not cover recall %.1fms and rank %.1fms!" % (
+                slo_ms, recall_ms, rank_fixed_ms))
+        candidates = self.budget.candidates
+        if rank_row_ms > 0:
+            candidates = min(candidates, int(available_ms / rank_row_ms))
+        if candidates < self.budget.results:
+            raise ValueError("latency slo %.1fms only affords %d rank candidates, less than %d results!" % (
+                slo_ms, candidates, self.budget.results))
+        # every experiment splits the candidates among its own recalls, a single recall gets all of them
+        experiments = {item.name: item for item in recommend_config.experiments}
+        quotas = dict()
+        for name in recall_experiments:
+            steps = experiment_steps(experiments[name], recall_services)
+            if steps:
+                quotas[name] = split_quotas(candidates, {step: self.recall_weight(step) for step in steps},
+                                            self.budget.min_quota)
+        # a recall service shared by experiments can only hold one limit, its largest quota
+        service_quotas = dict()
+        for experiment_quotas in quotas.values():
+            for step, quota in experiment_quotas.items():
+                service_quotas[step] = max(quota, service_quotas.get(step, 0))
+        # every stage keeps its estimate and gets a share of the slack proportional to it
+        rank_ms = rank_fixed_ms + candidates * rank_row_ms
+        scale = slo_ms / (recall_ms + rank_ms) if recall_ms + rank_ms > 0 else 1.0
+        recall_timeout = int(math.ceil(recall_ms * scale)) if rank_services else int(slo_ms)
+        rank_timeout = max(1, int(slo_ms) - recall_timeout)
+        timeouts = {name: recall_timeout for name in recall_services}
+        timeouts.update({name: rank_timeout for name in rank_services})
+        return {
+            "slo_ms": self.budget.slo_ms,
+            "stage_budget_ms": slo_ms,
+            "recall_ms": recall_ms,
+            "rank_fixed_ms": rank_fixed_ms,
+            "rank_row_ms": rank_row_ms,
+            "candidates": candidates,
+            "results": self.budget.results,
+            "quotas": quotas,
+            "service_quotas": service_quotas,
+            "timeouts": timeouts,
+            "recall_experiments": recall_experiments,
+            "rank_experiments": rank_experiments,
+        }
+
+    def apply(self):
+        """write the plan into service, experiment and scene options, return the plan"""
+        plan = self.plan()
+        recommend_config = self.server_config.recommend_service
+        services = {item.name: item for item in recommend_config.services}
+        experiments = {item.name: item for item in recommend_config.experiments}
+        for name, quota in plan["service_quotas"].items():
+            services[name].options["maxReservation"] = quota
+        for name in plan["rank_experiments"]:
+            experiments[name].options["maxReservation"] = plan["results"]
+        for name, timeout in plan["timeouts"].items():
+            services[name].options["timeout"] = timeout
+            if name not in plan["service_quotas"]:
+                services[name].options["maxReservation"] = plan["candidates"]
+        for name, quotas in plan["quotas"].items():
+            # the quotas of an experiment sum to the candidates, where a shared recall keeps a larger limit
+            # the merged cutOff by score trims the experiment back to them
+            experiments[name].options["maxReservation"] = sum(quotas.values())
+        for scene in recommend_config.scenes:
+            scene.options["timeout"] = int(self.budget.slo_ms)
+        return plan
+
+
+def plan_latency_budget(server_config, budget, profile=None):
+    return LatencyPlanner(server_config, budget, profile).apply()
+
+
+if __name__ == '__main__':
+    from attrs import evolve
+    from online_flow import LatencyBudget
+    from online_generator import OnlineGenerator, get_demo_jpa_flow
+    generator = OnlineGenerator(configure=evolve(get_demo_jpa_flow(), latency_budget=LatencyBudget()))
+    print(json.dumps(generator.gen_latency_plan(), indent=2))
@@ -0,0 +1,171 @@
+#
+# Copyright 2022 DMetaSoul
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+from common import DumpConfig
+from online_flow import OnlineFlow, ServiceInfo, DataSource, FeatureInfo, CFModelInfo, RankModelInfo, DockerInfo, \
+    RandomModelInfo, CrossFeature
+from online_generator import OnlineGenerator
+
+DEFAULT_SCALE = {"cf_models": 2, "rank_models": 1, "columns": 10, "cross_features": 2, "dockers": 2}
+
+DEFAULT_SWEEP = {
+    "cf_models": [1, 10, 50, 200],
+    "rank_models": [1, 10, 50],
+    "columns": [10, 100, 1000, 5000],
+    "cross_features": [2, 50, 500],
+    "dockers": [2, 10, 50],
+}
+
+DUMP_FORMATS = ["yaml", "yaml-fast", "json"]
+
+
+def gen_synthetic_flow(cf_models=2, rank_models=1, columns=10, cross_features=2, dockers=2):
+    services = dict()
+    services["mongo"] = ServiceInfo("127.0.0.1", 27017, "mongodb", ["bench"], {
+        "uri": "mongodb://root:example@${MONGO_HOST:127.0.0.1}:${MONGO_PORT:27017}/bench?authSource=admin",
+    })
+    user_columns = [{"user_id": "str"}, {"user_bhv_item_seq": "str"}]
+    user_columns.extend([{"user_feature_%d" % i: "str"} for i in range(columns)])
+    item_columns = [{"item_id": "str"}]
+    item_columns.extend([{"item_feature_%d" % i: "str"} for i in range(columns)])
+    summary_columns = [{"item_id": "str"}]
+    summary_columns.extend([{"summary_field_%d" % i: "str"} for i in range(columns)])
+    user = DataSource("bench_user", "mongo", "bench", user_columns)
+    item = DataSource("bench_item", "mongo", "bench", item_columns)
+    summary = DataSource("bench_summary", "mongo", "bench", summary_columns)
+    source = FeatureInfo(user, item, summary, None, None, None, None, None)
+    random_model = RandomModelInfo("pop", 10, DataSource("bench_pop", "mongo", "bench", None))
+    cf_model_list = [CFModelInfo("cf_%d" % i, DataSource("bench_cf_%d" % i, "mongo", "bench", None))
+                     for i in range(cf_models)]
+    crosses = [CrossFeature("cross_%d" % i, "#", ["user_feature_%d" % (i % max(columns, 1)),
+                                                  "item_feature_%d" % (i % max(columns, 1))])
+               for i in range(cross_features)]
+    rank_model_list = list()
+    for i in range(rank_models):
+        sparse = ["user_id", "item_id"]
+        sparse.extend([cross.name for cross in crosses])
+        rank_model_list.append(RankModelInfo("rank_%d" % i, "bench_model_%d" % i,
+                                             [{"dnn_sparse": sparse}, {"lr_sparse": sparse}], crosses))
+    docker_infos = {"mongo": DockerInfo("mongo:6.0.1", {"MONGO_INITDB_ROOT_USERNAME": "root",
+                                                         "MONGO_INITDB_ROOT_PASSWORD": "example"})}
+    for i in range(max(dockers - 1, 0)):
+        docker_infos["redis_%d" % i] = DockerInfo("redis:7.0.4", {})
+    return OnlineFlow(source, random_model, cf_model_list, [], rank_model_list, services, docker_infos)
+
+
+def measure(func, repeat):
+    """best wall time over untraced runs, peak memory from one more run under tracemalloc"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        cost = time.perf_counter() - start
+        best = cost if best is None else min(best, cost)
+    # tracing every allocation slows the run down, so it is kept out of the timed runs
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, {"seconds": best, "peak_bytes": peak}
+
+
+def bench_flow(scale, repeat=3, formats=None):
+    formats = formats or DUMP_FORMATS
+    generator = OnlineGenerator(configure=gen_synthetic_flow(**scale))
+    stages = dict()
+    server_config, stages["generate"] = measure(generator.build_server_config, repeat)
+    data, stages["serialize"] = measure(server_config.to_dict, repeat)
+    output_bytes = dict()
+    for fmt in formats:
+        content, stages["dump_%s" % fmt] = measure(lambda: DumpConfig(data, fmt=fmt), repeat)
+        output_bytes[fmt] = len(content.encode("utf-8") if isinstance(content, str) else content)
+    _, stages["gen_server_config"] = measure(generator.gen_server_config, repeat)
+    _, stages["gen_docker_compose"] = measure(generator.gen_docker_compose, repeat)
+    return {"scale": dict(scale), "stages": stages, "output_bytes": output_bytes}
+
+
+def run_sweep(sweep=None, repeat=3, formats=None):
+    results = list()
+    for dimension, values in (sweep or DEFAULT_SWEEP).items():
+        for value in values:
+            scale = dict(DEFAULT_SCALE)
+            scale[dimension] = value
+            result = bench_flow(scale, repeat, formats)
+            result["dimension"] = dimension
+            results.append(result)
+    return results
+
+
+def result_key(result):
+    return json.dumps(result["scale"], sort_keys=True)
+
+
+def compare_results(baseline, current, threshold=0.2):
+    regressions = list()
+    baseline_index = {result_key(item): item for item in baseline}
+    for item in current:
+        base = baseline_index.get(result_key(item))
+        if not base:
+            continue
+        for stage, value in item["stages"].items():
+            base_value = base["stages"].get(stage)
+            if not base_value:
+                continue
+            for metric in ("seconds", "peak_bytes"):
+                if base_value[metric] and value[metric] > base_value[metric] * (1 + threshold):
+                    regressions.append({"scale": item["scale"], "stage": stage, "metric": metric,
+                                        "baseline": base_value[metric], "current": value[metric]})
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="benchmark online config generation on synthetic flows")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--formats", default=",".join(DUMP_FORMATS))
+    parser.add_argument("--quick", action="store_true", help="only run the default scale")
+    parser.add_argument("--output", help="write json results to this file instead of stdout")
+    parser.add_argument("--baseline", help="json results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative regression")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    formats = args.formats.split(",")
+    if args.quick:
+        results = [bench_flow(DEFAULT_SCALE, args.repeat, formats)]
+    else:
+        results = run_sweep(repeat=args.repeat, formats=formats)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_results(json.load(baseline_file), results, args.threshold)
+        for regression in regressions:
+            print("regression: %s" % json.dumps(regression), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
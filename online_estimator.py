@@ -0,0 +1,248 @@
+#
+# Copyright 2022 DMetaSoul
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+
+from attrs import define, field, frozen
+
+from online_flow import OnlineFlow
+
+
+@frozen
+class SourceProfile(object):
+    latency_ms: float = 2.0
+    row_cost_ms: float = 0.01
+
+
+@define
+class CostProfile(object):
+    # keyed by source name first, then by source kind (MongoDB, JDBC, Redis, ...)
+    sources: dict = field(factory=lambda: {"Request": SourceProfile(0.0, 0.0), "Redis": SourceProfile(0.5, 0.002)})
+    default_source: SourceProfile = field(factory=SourceProfile)
+    user_profile_rows: int = 50
+    matcher_fanout: int = 20
+    field_action_row_cost_ms: float = 0.001
+    inference_latency_ms: float = 5.0
+    inference_row_cost_ms: float = 0.02
+    service_overhead_ms: float = 0.5
+
+    def source(self, name, kind):
+        return self.sources.get(name) or self.sources.get(kind) or self.default_source
+
+
+@frozen
+class StageCost(object):
+    latency_ms: float
+    rows: int
+    calls: int = 0
+    fetched_rows: int = 0
+    path: tuple = ()
+
+
+def max_cost(costs):
+    return max(costs, key=lambda cost: cost.latency_ms) if costs else None
+
+
+class PipelineCostModel(object):
+    """estimate fan-out, fetched rows and critical path latency of a generated OnlineServiceConfig"""
+
+    def __init__(self, server_config, profile=None):
+        self.profile = profile or CostProfile()
+        feature_config = server_config.feature_service
+        recommend_config = server_config.recommend_service
+        self.sources = {item.name: item for item in feature_config.source}
+        self.source_tables = {item.name: item for item in feature_config.sourceTable}
+        self.features = {item.name: item for item in feature_config.feature}
+        self.algo_transforms = {item.name: item for item in feature_config.algoTransform}
+        self.services = {item.name: item for item in recommend_config.services}
+        self.experiments = {item.name: item for item in recommend_config.experiments}
+        self.layers = {item.name: item for item in recommend_config.layers}
+        self.scenes = {item.name: item for item in recommend_config.scenes}
+        self.stages = dict()
+        self._memo = dict()
+
+    def table_profile(self, name):
+        source = self.sources.get(self.source_tables[name].source)
+        kind = source.kind if source else "Request"
+        return kind, self.profile.source(source.name if source else None, kind)
+
+    def feature_cost(self, name, input_rows):
+        feature = self.features[name]
+        drivers = list()
+        lookups = list()
+        for depend in feature.depend or []:
+            if depend in self.source_tables:
+                kind, _ = self.table_profile(depend)
+                if kind != "Request":
+                    lookups.append(depend)
+            else:
+                drivers.append(self.node_cost(depend, input_rows))
+        upstream = max_cost(drivers)
+        rows = max([cost.rows for cost in drivers]) if drivers else 1
+        calls = sum(cost.calls for cost in drivers)
+        fetched_rows = sum(cost.fetched_rows for cost in drivers)
+        lookup_latency = 0.0
+        for table in lookups:
+            _, source_profile = self.table_profile(table)
+            lookup_latency = max(lookup_latency, source_profile.latency_ms + rows * source_profile.row_cost_ms)
+            calls += 1
+            fetched_rows += rows
+        latency = (upstream.latency_ms if upstream else 0.0) + lookup_latency
+        return StageCost(latency, rows, calls, fetched_rows, (upstream.path if upstream else ()) + (name,))
+
+    def algo_transform_cost(self, name, input_rows):
+        algo_transform = self.algo_transforms[name]
+        upstream_costs = [self.node_cost(item, input_rows)
+                          for item in list(algo_transform.feature or []) + list(algo_transform.algoTransform or [])]
+        upstream = max_cost(upstream_costs)
+        rows = max([cost.rows for cost in upstream_costs]) if upstream_costs else 1
+        latency = (upstream.latency_ms if upstream else 0.0) + \
+            rows * self.profile.field_action_row_cost_ms * len(algo_transform.fieldActions or [])
+        if algo_transform.taskName == "AlgoInference":
+            latency += self.profile.inference_latency_ms + rows * self.profile.inference_row_cost_ms
+        if algo_transform.taskName == "UserProfile":
+            rows = rows * self.profile.user_profile_rows
+        elif algo_transform.taskName == "ItemMatcher":
+            rows = rows * self.profile.matcher_fanout
+        return StageCost(latency, rows, sum(cost.calls for cost in upstream_costs),
+                         sum(cost.fetched_rows for cost in upstream_costs),
+                         (upstream.path if upstream else ()) + (name,))
+
+    def node_cost(self, name, input_rows):
+        key = (name, input_rows)
+        if key in self._memo:
+            return self._memo[key]
+        if name in self.features:
+            cost = self.feature_cost(name, input_rows)
+        elif name in self.algo_transforms:
+            cost = self.algo_transform_cost(name, input_rows)
+        else:
+            # candidate table fed by the recommend service itself, e.g. rank_<name>
+            return StageCost(0.0, input_rows)
+        self._memo[key] = cost
+        self.stages[name] = cost
+        return cost
+
+    def service_cost(self, name, input_rows):
+        service = self.services[name]
+        task_costs = [self.node_cost(task, input_rows) for task in service.tasks or []]
+        upstream = max_cost(task_costs)
+        rows = sum(cost.rows for cost in task_costs) if task_costs else input_rows
+        max_reservation = (service.options or {}).get("maxReservation")
+        if max_reservation:
+            rows = min(rows, max_reservation)
+        cost = StageCost((upstream.latency_ms if upstream else 0.0) + self.profile.service_overhead_ms, rows,
+                         sum(cost.calls for cost in task_costs), sum(cost.fetched_rows for cost in task_costs),
+                         (upstream.path if upstream else ()) + (name,))
+        self.stages[name] = cost
+        return cost
+
+    def step_cost(self, name, input_rows):
+        if name in self.services:
+            return self.service_cost(name, input_rows)
+        if name in self.experiments:
+            return self.experiment_cost(name, input_rows)
+        if name in self.layers:
+            return self.layer_cost(name, input_rows)
+        raise ValueError("chain step %s is not a service, experiment or layer!" % name)
+
+    def chain_cost(self, chain, input_rows):
+        latency = 0.0
+        rows = input_rows
+        calls = 0
+        fetched_rows = 0
+        path = ()
+        if chain.when:
+            branches = [self.step_cost(name, input_rows) for name in chain.when]
+            slowest = max_cost(branches)
+            latency, path = slowest.latency_ms, slowest.path
+            rows = sum(cost.rows for cost in branches)
+            calls = sum(cost.calls for cost in branches)
+            fetched_rows = sum(cost.fetched_rows for cost in branches)
+        for name in chain.then or []:
+            cost = self.step_cost(name, rows)
+            latency += cost.latency_ms
+            rows = cost.rows
+            calls += cost.calls
+            fetched_rows += cost.fetched_rows
+            path = path + cost.path
+        return StageCost(latency, rows, calls, fetched_rows, path)
+
+    def chains_cost(self, name, chains, options, input_rows):
+        costs = [self.chain_cost(chain, input_rows) for chain in chains or []]
+        slowest = max_cost(costs)
+        rows = sum(cost.rows for cost in costs) if costs else input_rows
+        max_reservation = (options or {}).get("maxReservation")
+        if max_reservation:
+            rows = min(rows, max_reservation)
+        cost = StageCost(slowest.latency_ms if slowest else 0.0, rows, sum(cost.calls for cost in costs),
+                         sum(cost.fetched_rows for cost in costs), (slowest.path if slowest else ()) + (name,))
+        self.stages[name] = cost
+        return cost
+
+    def experiment_cost(self, name, input_rows):
+        experiment = self.experiments[name]
+        return self.chains_cost(name, experiment.chains, experiment.options, input_rows)
+
+    def layer_cost(self, name, input_rows):
+        layer = self.layers[name]
+        costs = [(item.ratio, self.experiment_cost(item.name, input_rows)) for item in layer.experiments or []]
+        if not costs:
+            return StageCost(0.0, input_rows, path=(name,))
+        slowest = max_cost([cost for _, cost in costs])
+        expected_latency = sum(ratio * cost.latency_ms for ratio, cost in costs)
+        cost = StageCost(slowest.latency_ms, max(cost.rows for _, cost in costs),
+                         max(cost.calls for _, cost in costs), max(cost.fetched_rows for _, cost in costs),
+                         slowest.path + (name,))
+        self.stages[name] = cost
+        self.stages["%s.expected" % name] = StageCost(expected_latency, cost.rows, path=(name,))
+        return cost
+
+    def scene_cost(self, name):
+        scene = self.scenes[name]
+        return self.chains_cost(name, scene.chains, scene.options, 1)
+
+    def estimate(self, scene=None):
+        names = [scene] if scene else list(self.scenes.keys())
+        report = dict()
+        for name in names:
+            cost = self.scene_cost(name)
+            expected_latency = sum(self.stages["%s.expected" % layer].latency_ms
+                                   for chain in self.scenes[name].chains or [] for layer in chain.then or []
+                                   if "%s.expected" % layer in self.stages)
+            report[name] = {
+                "latency_ms": cost.latency_ms,
+                "expected_latency_ms": expected_latency,
+                "rows": cost.rows,
+                "source_calls": cost.calls,
+                "fetched_rows": cost.fetched_rows,
+                "critical_path": list(cost.path),
+                "stages": {stage: {"latency_ms": item.latency_ms, "rows": item.rows}
+                           for stage, item in self.stages.items()},
+            }
+        return report
+
+
+def estimate_latency(configure, profile=None, scene=None):
+    """configure: OnlineFlow or a built OnlineServiceConfig"""
+    if isinstance(configure, OnlineFlow):
+        from online_generator import OnlineGenerator
+        configure = OnlineGenerator(configure=configure).build_server_config()
+    return PipelineCostModel(configure, profile).estimate(scene)
+
+
+if __name__ == '__main__':
+    from online_generator import get_demo_jpa_flow
+    print(json.dumps(estimate_latency(get_demo_jpa_flow()), indent=2))
@@ -13,10 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import json
+import os
 import subprocess
 import time
 
-from cloud_consul import putServiceConfig
+from cloud_consul import putServiceConfig, putServiceConfigSections, getConsul, getServiceConfigVersion, sectionsVersion, \
+    waitForValue
+from common import DumpConfig
+from index_plan import apply_index_plan
+from online_health import HealthProber
 from online_flow import DataSource, FeatureInfo, CFModelInfo, OnlineFlow
 from online_generator import OnlineGenerator, get_demo_jpa_flow
 from enum import Enum
@@ -27,39 +33,169 @@ def run_cmd(command):
 
 
 class OnlineExecutor(object):
-    def __init__(self, config):
+    def __init__(self, config, **kwargs):
         self._config = config
         self._generator = OnlineGenerator(configure=config)
+        self._consul = kwargs.get("consul_client") or getConsul(kwargs.get("consul_host", "localhost"),
+                                                                kwargs.get("consul_port", 8500))
+        # the stock recommend service does not report what it loaded. waiting on this key is opt-in (wait_loaded)
+        # and needs a deployment hook that writes the loaded manifest version here after each reload
+        self._loaded_version_key = kwargs.get("loaded_version_key", "config/recommend/loaded_version")
+
+    def push_config(self, **kwargs):
+        """return (changed sections, pushed version), the version is None when consul does not hold the push"""
+        # the recommend service reads the full config from the data key, the sections beside it are only used
+        # to detect which parts changed. both are rendered from one build of the config
+        server_config = self._generator.build_server_config()
+        putServiceConfig(DumpConfig(server_config), client=self._consul)
+        sections = self._generator.gen_server_config_sections(server_config=server_config)
+        changed = putServiceConfigSections(sections, client=self._consul)
+        version = getServiceConfigVersion(self._consul)
+        return changed, version if version == sectionsVersion(sections) else None
+
+    def wait_config_loaded(self, version, timeout=60):
+        return waitForValue(self._consul, self._loaded_version_key, version, timeout)
+
+    @staticmethod
+    def state_file(**kwargs):
+        docker_compose_yaml = kwargs.setdefault("docker_compose_file", "docker_compose.yml")
+        return kwargs.get("state_file") or "%s.state.json" % docker_compose_yaml
+
+    @staticmethod
+    def load_state(state_file):
+        if not os.path.exists(state_file):
+            return None
+        with open(state_file) as state:
+            return json.load(state).get("services")
+
+    @staticmethod
+    def save_state(state_file, hashes):
+        with open(state_file, "w") as state:
+            json.dump({"services": hashes}, state, indent=2, sort_keys=True)
+
+    def diff_services(self, **kwargs):
+        """return (new hashes, changed services, removed services) against the last deployment, None if unknown"""
+        hashes = self._generator.gen_docker_compose_hashes()
+        deployed = self.load_state(self.state_file(**kwargs))
+        if deployed is None:
+            return hashes, None, []
+        changed = [name for name, digest in hashes.items() if deployed.get(name) != digest]
+        removed = [name for name in deployed if name not in hashes]
+        return hashes, changed, removed
 
     def execute_up(self, **kwargs):
         docker_compose_yaml = kwargs.setdefault("docker_compose_file", "docker_compose.yml")
-        compose_content = self._generator.gen_docker_compose()
-        docker_compose = open(docker_compose_yaml, "w")
-        docker_compose.write(compose_content)
-        docker_compose.close()
-        if run_cmd(["docker-compose -f %s up -d" % docker_compose_yaml]) == 0:
-            online_recommend_config = self._generator.gen_server_config()
-            putServiceConfig(online_recommend_config)
-            print("online flow up success!")
-        else:
+        hashes, changed, removed = self.diff_services(**kwargs)
+        with open(docker_compose_yaml, "w") as docker_compose:
+            self._generator.gen_docker_compose(stream=docker_compose)
+        self.write_load_balancer_configs(docker_compose_yaml)
+        if removed and run_cmd(["docker-compose -f %s rm -s -f %s" % (docker_compose_yaml, " ".join(removed))]) != 0:
+            print("online flow up fail, remove services %s fail!" % removed)
+            return False
+        ret = 0
+        if changed:
+            ret = run_cmd(["docker-compose -f %s up -d --no-deps --force-recreate %s" % (
+                docker_compose_yaml, " ".join(changed))])
+        if ret == 0:
+            # a plain up still starts stopped or crashed containers of unchanged services
+            ret = run_cmd(["docker-compose -f %s up -d" % docker_compose_yaml])
+        if ret != 0:
             print("online flow up fail!")
+            return False
+        self.save_state(self.state_file(**kwargs), hashes)
+        self.push_config(**kwargs)
+        if kwargs.get("mongo_client") is not None:
+            self.ensure_indexes(kwargs["mongo_client"], kwargs.get("build_indexes", True))
+        if kwargs.get("wait_ready", True) and not self.wait_ready(**kwargs).ready:
+            print("online flow up fail, services not ready in time!")
+            return False
+        print("online flow up success! recreated: %s removed: %s" % ("all" if changed is None else changed, removed))
+        return True
+
+    def write_load_balancer_configs(self, docker_compose_yaml):
+        volume_dir = os.environ.get("DOCKER_VOLUME_DIRECTORY") or os.path.dirname(docker_compose_yaml) or "."
+        for path, content in self._generator.gen_load_balancer_configs().items():
+            path = os.path.join(volume_dir, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as config_file:
+                config_file.write(content)
+
+    def ensure_indexes(self, mongo_client, build=True, database=None):
+        """build the indexes of the index plan, with build=False only report the missing ones"""
+        report = apply_index_plan(mongo_client, self._generator.gen_index_plan(), build, database)
+        for spec in report["created"]:
+            print("index %s.%s on %s created, unique: %s" % (spec["database"], spec["collection"], spec["field"],
+                                                             spec["unique"]))
+        for spec in report["missing"]:
+            print("index %s.%s on %s missing!" % (spec["database"], spec["collection"], spec["field"]))
+        return report
 
     def execute_down(self, **kwargs):
-        if run_cmd(["docker-compose down"]) == 0:
+        docker_compose_yaml = kwargs.setdefault("docker_compose_file", "docker_compose.yml")
+        if run_cmd(["docker-compose -f %s down" % docker_compose_yaml]) == 0:
+            state_file = self.state_file(**kwargs)
+            if os.path.exists(state_file):
+                os.remove(state_file)
             print("online flow down success!")
         else:
             print("online flow down fail!")
 
+    def health_prober(self, **kwargs):
+        return HealthProber(self._generator.build_docker_compose(), hosts=kwargs.get("hosts"),
+                            container_probe=kwargs.get("container_probe"),
+                            version_probe=lambda: self._consul.getValue(self._loaded_version_key),
+                            # opt-in, only when the deployment writes the loaded version, see loaded_version_key
+                            expected_version=getServiceConfigVersion(self._consul) if kwargs.get(
+                                "check_config_version", False) else None,
+                            timeout=kwargs.get("probe_timeout", 1.0), health_paths=kwargs.get("health_paths"))
+
     def execute_status(self, **kwargs):
-        pass
+        report = self.health_prober(**kwargs).probe_all()
+        print(json.dumps(report.to_dict(), indent=2))
+        return report
+
+    def wait_ready(self, **kwargs):
+        report = self.health_prober(**kwargs).wait_ready(kwargs.get("ready_timeout", 120),
+                                                         kwargs.get("ready_interval", 1.0))
+        for name, status in report.services.items():
+            if name in report.time_to_ready:
+                print("service %s ready in %.2fs" % (name, report.time_to_ready[name]))
+            else:
+                print("service %s not ready, state: %s ports: %s" % (name, status.state, status.ports))
+        return report
 
     def execute_reload(self, **kwargs):
+        """
+        apply a new online flow: changed containers are recreated through execute_up, a config only change is
+        pushed to consul for the recommend service consul watch. a push is only reported as loaded with
+        wait_loaded, which waits for the deployment hook to write the loaded version, see loaded_version_key.
+        """
         new_flow = kwargs.setdefault("configure", None)
+        if not new_flow or not isinstance(new_flow, OnlineFlow):
+            raise ValueError("MetaSpore Online reload need input online configure data!")
+        new_generator = OnlineGenerator(configure=new_flow)
+        containers_changed = new_generator.gen_docker_compose() != self._generator.gen_docker_compose()
         self._config = new_flow
-        self._generator = OnlineGenerator(configure=self._config)
-        self.execute_down(**kwargs)
-        self.execute_up(**kwargs)
-        print("online flow reload success!")
+        self._generator = new_generator
+        if containers_changed:
+            # only the services whose definition changed are recreated, the rest keep running
+            return self.execute_up(**kwargs)
+        # only the service config changed: the recommend service picks it up through its consul watch
+        changed, version = self.push_config(**kwargs)
+        if version is None:
+            print("online flow reload fail, pushed config version not found in consul!")
+            return False
+        if not changed:
+            print("online flow config unchanged, nothing pushed!")
+            return True
+        if not kwargs.get("wait_loaded", False):
+            print("online flow config pushed, not confirmed as loaded, sections: %s version: %s" % (changed, version))
+            return True
+        if self.wait_config_loaded(version, kwargs.get("timeout", 60)):
+            print("online flow config loaded, sections: %s version: %s" % (changed, version))
+            return True
+        print("online flow reload fail, version %s not loaded in time!" % version)
+        return False
 
 
 if __name__ == "__main__":
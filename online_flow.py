@@ -17,10 +17,28 @@ from attrs import frozen
 from attrs import field
 
 
+@frozen
+class DockerResources(object):
+    cpus: float = None
+    mem_limit: str = None
+    mem_reservation: str = None
+    cpuset: str = None
+    shm_size: str = None
+    ulimits: dict = None
+    restart_max_attempts: int = None
+    restart_delay: str = None
+    restart_window: str = None
+
+
 @frozen
 class DockerInfo(object):
     image: str
     environment: dict
+    resources: DockerResources = None
+    replicas: int = 1
+    # a compose healthcheck test such as ["CMD", "grpc_health_probe", "-addr=:50000"], for images without the
+    # tools the default check of the service kind uses
+    healthcheck: list = None
 
 
 @frozen
@@ -32,19 +50,51 @@ class ServiceInfo(object):
     options: dict
 
 
+@frozen
+class CacheInfo(object):
+    serviceName: str = "redis"
+    ttl: int = 600
+    prefix: str = None
+    max_entries: int = 100000
+    # seconds to remember keys missing in the backing table, 0 disables negative caching
+    negative_ttl: int = 60
+    max_memory: str = "512mb"
+
+
+@frozen
+class ResultCacheInfo(object):
+    # request columns keying the cached scene result, the user key when empty
+    key_fields: list = None
+    ttl: int = 30
+    max_entries: int = 10000
+    # redis service holding the results shared by all recommend replicas, None keeps them in process
+    serviceName: str = None
+    prefix: str = None
+    max_memory: str = "256mb"
+
+
 @frozen
 class DataSource(object):
     table: str
     serviceName: str
     collection: str
     columns: list
+    cache: CacheInfo = None
 
 
 @frozen
 class MilvusInfo(object):
     collection: str
     fields: list
-    serviceName: str
+    serviceName: str = "milvus"
+    vector_field: str = "embedding"
+    metric: str = "IP"
+    index_type: str = "IVF_FLAT"
+    nlist: int = 1024
+    # ivf indexes search nprobe of nlist buckets, hnsw keeps ef candidates, both trade recall for latency
+    nprobe: int = 16
+    ef: int = 256
+    top_k: int = 200
 
 
 @frozen
@@ -65,6 +115,7 @@ class TwoTowerModelInfo(object):
     name: str
     model: str
     milvus: MilvusInfo
+    column_info: list = None
 
 
 @frozen
@@ -82,6 +133,34 @@ class RankModelInfo(object):
     cross_features: list
 
 
+@frozen
+class LatencyBudget(object):
+    slo_ms: float = 100.0
+    # share of the slo kept for network, serialization and jitter outside the planned stages
+    headroom: float = 0.2
+    # candidates scored by rank at most, split into per recall quotas before summaryBySchema merges them
+    candidates: int = 200
+    results: int = 20
+    min_quota: int = 10
+    # recall model name -> quota weight, equal weights when missing
+    recall_weights: dict = None
+    # service name -> fixed ms or [fixed ms, ms per candidate], measured or declared, overrides the cost model
+    stage_costs: dict = None
+
+
+@frozen
+class FallbackPolicy(object):
+    # recall service or model to run instead, "skip" passes candidates through in recall order,
+    # None falls back to the random_model recall for recall stages and skips rank stages
+    fallback: str = None
+    # defaults to the timeout planned from latency_budget
+    timeout_ms: int = None
+    # consecutive failures opening the breaker, calls go straight to the fallback while it is open
+    failure_threshold: int = 5
+    open_ms: int = 10000
+    half_open_calls: int = 1
+
+
 @frozen
 class FeatureInfo(object):
     user: DataSource
@@ -103,6 +182,10 @@ class OnlineFlow(object):
     rank_models: list
     services: dict
     dockers: dict
+    latency_budget: LatencyBudget = None
+    # service name, or recall/rank for every service of that layer -> FallbackPolicy
+    fallbacks: dict = None
+    result_cache: ResultCacheInfo = None
 
 
 
@@ -13,14 +13,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-from cloud_consul import putServiceConfig
-from common import DumpToYaml
-from compose_config import OnlineDockerCompose
+import json
+
+from cloud_consul import putServiceConfig, putServiceConfigSections
+from common import DumpToYaml, DumpConfig, ContentHash, S
+from compose_config import OnlineDockerCompose, resource_kwargs, healthcheck_kwargs, load_balancer_config_path, \
+    nginx_config
+from k8s_config import K8sOptions, build_k8s_manifests, validate_manifests, dump_k8s_manifests
+from index_plan import build_index_plan
+from config_optimizer import merge_common_nodes, prune_unused_columns
+from latency_planner import LatencyPlanner, plan_latency_budget
+from fallback_policy import apply_fallback_policies
 from online_flow import OnlineFlow, ServiceInfo, DataSource, FeatureInfo, CFModelInfo, RankModelInfo, DockerInfo, \
     RandomModelInfo, CrossFeature
-from service_config import get_source_option, Source, Condition, FieldAction, \
+from service_config import get_source_option, get_redis_option, get_jdbc_credentials, get_cache_option, \
+    get_milvus_option, get_result_cache_option, Source, Condition, FieldAction, \
     FeatureConfig, RecommendConfig, TransformConfig, Chain, ExperimentItem, OnlineServiceConfig
 
+DEFAULT_RECOMMEND_IMAGE = "dmetasoul/recommend-service-11:1.0"
+DEFAULT_MODEL_IMAGE = "swr.cn-southwest-2.myhuaweicloud.com/dmetasoul-public/metaspore-serving-release:cpu-v1.0.1"
+
 
 def append_source_table(feature_config, name, datasource, default_columns=[]):
     if feature_config is None or not datasource:
@@ -36,7 +48,88 @@ def append_source_table(feature_config, name, datasource, default_columns=[]):
     if not columns:
         raise ValueError("ds columns must not be empty")
     feature_config.add_sourceTable(name=name, source=source_name, table=datasource.table,
-                                   columns=columns)
+                                   columns=columns, options=get_cache_option(datasource) if datasource.cache else {})
+
+
+def get_data_sources(configure):
+    sources = list()
+    if configure.source:
+        sources.extend([configure.source.user, configure.source.item, configure.source.summary])
+    if configure.random_model:
+        sources.append(configure.random_model.source)
+    sources.extend([model.source for model in configure.cf_models or []])
+    return [source for source in sources if source]
+
+
+def get_mysql_services(configure):
+    """jdbc services backed by mysql, local ones get a mysql container unless one is configured in dockers"""
+    services = dict()
+    for name, info in (configure.services or {}).items():
+        if str(info.kind).lower() != "jdbc":
+            continue
+        uri = (info.options or {}).get("uri")
+        if not uri or str(uri).startswith("jdbc:mysql"):
+            services[name] = info
+    return services
+
+
+def is_local_mysql(name, info):
+    """a mysql reached at localhost or by its service name runs in the compose network, others are external"""
+    local_hosts = ("localhost", "127.0.0.1", name)
+    uri = (info.options or {}).get("uri")
+    if not uri:
+        return not info.host or info.host in local_hosts
+    host = str(uri).split("//", 1)[-1].split("/", 1)[0]
+    if host.startswith("${"):
+        # a ${NAME_HOST:default} placeholder, the default is where it points without an injected host
+        host = host[2:].split("}", 1)[0].split(":", 1)[-1]
+    return host.rsplit(":", 1)[0] in local_hosts
+
+
+def get_mysql_environment(configure, name, info):
+    user, password = get_jdbc_credentials(configure, name, info)
+    if not user:
+        raise ValueError("jdbc service %s must set user and password!" % name)
+    environment = dict()
+    if info.collection:
+        environment["MYSQL_DATABASE"] = info.collection[0]
+    if user == "root":
+        environment["MYSQL_ROOT_PASSWORD"] = password
+    else:
+        environment["MYSQL_USER"] = user
+        environment["MYSQL_PASSWORD"] = password
+        environment["MYSQL_RANDOM_ROOT_PASSWORD"] = S("yes")
+    return environment
+
+
+def get_mysql_command(configure, info):
+    """raise max_connections above the pools of all recommend replicas when the default 151 is too low"""
+    pool_size = int((info.options or {}).get("maxPoolSize") or 0)
+    recommend = (configure.dockers or {}).get("recommend")
+    connections = pool_size * (recommend.replicas if recommend else 1) + 20
+    if connections <= 151:
+        return None
+    return "mysqld --max-connections=%d" % connections
+
+
+def get_milvus_services(configure):
+    """milvus services searched by the two-tower models"""
+    services = list()
+    for model in configure.twotower_models or []:
+        if model.milvus and model.milvus.serviceName not in services:
+            services.append(model.milvus.serviceName)
+    return services
+
+
+def get_cache_services(configure):
+    """redis services caching data sources or scene results, mapped to the first CacheInfo using them"""
+    caches = dict()
+    for datasource in get_data_sources(configure):
+        if datasource.cache:
+            caches.setdefault(datasource.cache.serviceName, datasource.cache)
+    if configure.result_cache and configure.result_cache.serviceName:
+        caches.setdefault(configure.result_cache.serviceName, configure.result_cache)
+    return caches
 
 
 def columns_has_key(columns, key):
@@ -53,43 +146,128 @@ class OnlineGenerator(object):
         self.configure = kwargs.get("configure")
         if not self.configure or not isinstance(self.configure, OnlineFlow):
             raise ValueError("MetaSpore Online need input online configure data!")
+        self.merge_common = kwargs.get("merge_common", True)
+        self.prune_columns = kwargs.get("prune_columns", True)
+        self.cost_profile = kwargs.get("cost_profile")
 
-    def gen_docker_compose(self):
+    def build_docker_compose(self, replicate=True):
         online_docker_compose = OnlineDockerCompose()
         dockers = {}
         if self.configure.dockers:
             dockers.update(self.configure.dockers)
         if "recommend" not in dockers:
-            dockers["recommend"] = DockerInfo("dmetasoul/recommend-service-11:1.0", {})
+            dockers["recommend"] = DockerInfo(DEFAULT_RECOMMEND_IMAGE, {})
         no_mode_service = True
         for name in dockers.keys():
             if str(name).startswith("model"):
                 no_mode_service = False
                 break
         if no_mode_service:
-            dockers["model"] = \
-                DockerInfo("swr.cn-southwest-2.myhuaweicloud.com/dmetasoul-public/metaspore-serving-release:cpu-v1.0.1",
-                           {})
+            dockers["model"] = DockerInfo(DEFAULT_MODEL_IMAGE, {})
+        caches = get_cache_services(self.configure)
+        for name in caches:
+            if name not in dockers and name not in (self.configure.services or {}):
+                dockers[name] = DockerInfo("redis:7.0.4", {})
+        mysql_services = get_mysql_services(self.configure)
+        for name, info in mysql_services.items():
+            if name not in dockers and is_local_mysql(name, info):
+                dockers[name] = DockerInfo("mysql:8.0.30", get_mysql_environment(self.configure, name, info))
+        milvus_services = get_milvus_services(self.configure)
+        for name in milvus_services:
+            if name not in dockers and name not in (self.configure.services or {}):
+                dockers[name] = DockerInfo("milvusdb/milvus:v2.0.1", {})
+        replicated = dict()
         for name, info in dockers.items():
+            if replicate and (info.replicas or 1) > 1:
+                replicated[name] = online_docker_compose.add_replicated_service(
+                    name, "container_%s_service", info.replicas, image=info.image,
+                    environment=dict(info.environment or {}), **resource_kwargs(info.resources),
+                    **healthcheck_kwargs(info.healthcheck))
+                continue
+            cache_kwargs = dict()
+            if name in mysql_services:
+                cache_kwargs["kind"] = "mysql"
+                command = get_mysql_command(self.configure, mysql_services[name])
+                if command:
+                    cache_kwargs["command"] = command
+            if name in milvus_services:
+                cache_kwargs["kind"] = "milvus"
+            if name in caches:
+                cache_kwargs["kind"] = "redis"
+                cache_kwargs["command"] = "redis-server --maxmemory %s --maxmemory-policy allkeys-lru" % \
+                                          caches[name].max_memory
             online_docker_compose.add_service(name, "container_%s_service" % name,
-                                              image=info.image, environment=info.environment)
-        online_recommend_service = online_docker_compose.services.get("recommend")
-        if not online_recommend_service:
+                                              image=info.image, environment=dict(info.environment or {}),
+                                              **resource_kwargs(info.resources), **healthcheck_kwargs(info.healthcheck),
+                                              **cache_kwargs)
+        recommend_services = [online_docker_compose.services[name]
+                              for name in replicated.get("recommend", ["recommend"])
+                              if name in online_docker_compose.services]
+        if not recommend_services:
             raise ValueError("container_recommend_service init fail!")
-        if online_docker_compose.services:
-            for name, service in online_docker_compose.services.items():
-                if name == "recommend" or not service.ports:
-                    continue
+        members = {member for names in replicated.values() for member in names}
+        for name, service in list(online_docker_compose.services.items()):
+            if name == "recommend" or name in members or not service.ports:
+                continue
+            for online_recommend_service in recommend_services:
                 online_recommend_service.add_env("%s_HOST" % name.upper(), name)
                 online_recommend_service.add_env("%s_PORT" % name.upper(), service.ports[0])
-        return DumpToYaml(online_docker_compose)
+                if name not in online_recommend_service.depends_on:
+                    online_recommend_service.depends_on.append(name)
+        online_docker_compose.gate_depends_on()
+        return online_docker_compose
+
+    def gen_load_balancer_configs(self):
+        """nginx configs of the replicated tiers, keyed by their path relative to DOCKER_VOLUME_DIRECTORY"""
+        configs = dict()
+        for name, service in self.build_docker_compose().services.items():
+            members = ["%s_%d" % (name, index) for index in range(1, (self.replicas(name) or 1) + 1)]
+            if len(members) < 2:
+                continue
+            configs[load_balancer_config_path(name)] = nginx_config(name, members, service.ports[0],
+                                                                    grpc=str(name).startswith("model"))
+        return configs
+
+    def replicas(self, name):
+        info = (self.configure.dockers or {}).get(name)
+        return info.replicas if info else 1
+
+    def build_k8s_manifests(self, options=None):
+        options = options or K8sOptions()
+        online_docker_compose = self.build_docker_compose(replicate=False)
+        replicas = {name: self.replicas(name) or 1 for name in online_docker_compose.services}
+        server_config_yaml = self.gen_server_config() if options.config_store == "configmap" else None
+        manifests = build_k8s_manifests(online_docker_compose, replicas, server_config_yaml, options)
+        errors = validate_manifests(manifests)
+        if errors:
+            raise ValueError("k8s manifests invalid: %s!" % "; ".join(errors))
+        return manifests
 
-    def gen_server_config(self):
+    def gen_k8s_manifests(self, stream=None, options=None):
+        return dump_k8s_manifests(self.build_k8s_manifests(options), stream=stream)
+
+    def gen_docker_compose(self, stream=None):
+        return DumpToYaml(self.build_docker_compose(), stream=stream)
+
+    def gen_docker_compose_hashes(self):
+        services = self.build_docker_compose().to_dict().get("services", {})
+        configs = self.gen_load_balancer_configs()
+        hashes = dict()
+        for name, definition in services.items():
+            # the nginx config is a mounted file, its upstreams change with the replicas but not the definition
+            content = {"service": definition, "config": configs.get(load_balancer_config_path(name))}
+            hashes[name] = ContentHash(json.dumps(content, sort_keys=True, default=str))
+        return hashes
+
+    def build_server_config(self):
         feature_config = FeatureConfig(source=[Source(name="request"), ])
         recommend_config = RecommendConfig()
         if not self.configure.services:
             raise ValueError("services must set!")
         for name, info in self.configure.services.items():
+            if str(info.kind).lower() == "milvus":
+                # vector search runs in the MilvusSearch task, not through a feature source
+                continue
             if not info.collection:
                 feature_config.add_source(name=name, kind=info.kind,
                                           options=get_source_option(self.configure, name, None))
@@ -97,6 +275,9 @@ class OnlineGenerator(object):
                 for db in info.collection:
                     feature_config.add_source(name="%s_%s" % (name, db), kind=info.kind,
                                               options=get_source_option(self.configure, name, db))
+        for name in get_cache_services(self.configure):
+            if not feature_config.find_source(name):
+                feature_config.add_source(name=name, kind="Redis", options=get_redis_option(name))
         feature_info = self.configure.source
         if not feature_info:
             raise ValueError("feature_info must set!")
@@ -265,6 +446,61 @@ class OnlineGenerator(object):
                     ])
                 recall_experiments.append(experiment_name)
                 recall_services.append(service_name)
+        if self.configure.twotower_models:
+            for model_info in self.configure.twotower_models:
+                if not model_info.name or not model_info.model or not model_info.milvus:
+                    raise ValueError("twotower_models model name, model or milvus must not be empty")
+                column_info = model_info.column_info
+                if not column_info:
+                    column_info = [{"sparse": user_fields}]
+                embedding_name = "algotransform_%s_embedding" % model_info.name
+                feature_config.add_algoTransform(name=embedding_name,
+                                                 taskName="AlgoInference", feature=["feature_user"],
+                                                 options={"algo-name": model_info.name,
+                                                          "host": "${MODEL_HOST:localhost}",
+                                                          "port": "${MODEL_PORT:50000}"},
+                                                 fieldActions=[user_key_action,
+                                                               FieldAction(names=["embedding"], types=["list_float"],
+                                                                           algoColumns=column_info,
+                                                                           options={"modelName": model_info.model,
+                                                                                    "targetKey": "output",
+                                                                                    "targetIndex": 0},
+                                                                           func="predictEmbedding", input=[user_key])],
+                                                 output=[user_key, "embedding"])
+                milvus = model_info.milvus
+                milvus_service = self.configure.services.get(milvus.serviceName)
+                algoTransform_name = "algotransform_%s" % model_info.name
+                feature_config.add_algoTransform(name=algoTransform_name,
+                                                 taskName="MilvusSearch", algoTransform=[embedding_name],
+                                                 options={"algo-name": model_info.name,
+                                                          "host": "${%s_HOST:%s}" % (
+                                                              milvus.serviceName.upper(),
+                                                              milvus_service.host if milvus_service else "localhost"),
+                                                          "port": "${%s_PORT:%d}" % (
+                                                              milvus.serviceName.upper(),
+                                                              milvus_service.port if milvus_service else 19530)},
+                                                 fieldActions=[FieldAction(
+                                                     names=[user_key, item_key, "score", "origin_scores"],
+                                                     types=[user_key_type, item_key_type, "double", "map_str_double"],
+                                                     options=get_milvus_option(milvus, item_key),
+                                                     func="milvusSearch", input=[user_key, "embedding"])],
+                                                 output=[user_key, item_key, "score", "origin_scores"])
+                service_name = "recall_%s" % model_info.name
+                recommend_config.add_service(name=service_name, tasks=[algoTransform_name],
+                                             options={"maxReservation": 200})
+                experiment_name = "recall.%s" % model_info.name
+                recommend_config.add_experiment(name=experiment_name,
+                                                options={"maxReservation": 100}, chains=[
+                        Chain(then=[service_name], transforms=[
+                            TransformConfig(name="cutOff"),
+                            TransformConfig(name="updateField", option={
+                                "input": ["score", "origin_scores"], "output": ["origin_scores"],
+                                "updateOperator": "putOriginScores"
+                            })
+                        ])
+                    ])
+                recall_experiments.append(experiment_name)
+                recall_services.append(service_name)
         if len(recall_services) > 1:
             recommend_config.add_experiment(name="recall.multiple", options={"maxReservation": 100}, chains=[
                 Chain(when=recall_services, transforms=[
@@ -368,11 +604,47 @@ class OnlineGenerator(object):
                 ExperimentItem(name=name, ratio=1.0 / len(rank_experiments)) for name in rank_experiments
             ])
             layers.append(layer_name)
+        scene_options = dict()
+        if self.configure.result_cache:
+            scene_options["resultCache"] = get_result_cache_option(self.configure.result_cache, "guess-you-like",
+                                                                   request_fields, user_key)
         recommend_config.add_scene(name="guess-you-like", chains=[
             Chain(then=layers)],
-                                   columns=[{user_key: user_key_type}, {item_key: item_key_type}])
-        online_configure = OnlineServiceConfig(feature_config, recommend_config)
-        return DumpToYaml(online_configure).encode("utf-8").decode("latin1")
+                                   columns=[{user_key: user_key_type}, {item_key: item_key_type}],
+                                   options=scene_options)
+        if self.merge_common:
+            merge_common_nodes(feature_config, recommend_config)
+        if self.prune_columns:
+            prune_unused_columns(feature_config)
+        server_config = OnlineServiceConfig(feature_config, recommend_config)
+        if self.configure.latency_budget:
+            plan_latency_budget(server_config, self.configure.latency_budget, self.cost_profile)
+        if self.configure.fallbacks:
+            apply_fallback_policies(server_config, self.configure.fallbacks,
+                                    self.configure.random_model.name if self.configure.random_model else None)
+        return server_config
+
+    def gen_latency_plan(self):
+        """candidate quotas and stage timeouts the latency budget assigns"""
+        if not self.configure.latency_budget:
+            raise ValueError("latency_budget must set!")
+        return LatencyPlanner(self.build_server_config(), self.configure.latency_budget, self.cost_profile).plan()
+
+    def gen_index_plan(self):
+        """indexes the join conditions of the server config need on its mongo tables"""
+        return build_index_plan(self.build_server_config().feature_service)
+
+    def gen_server_config(self, stream=None, fmt="yaml"):
+        return DumpConfig(self.build_server_config(), stream=stream, fmt=fmt)
+
+    def gen_server_config_sections(self, fmt="yaml", server_config=None):
+        """sections of server_config, a config built with build_server_config, or of a newly built one"""
+        sections = dict()
+        server_config = server_config or self.build_server_config()
+        for name, data in server_config.to_sections().items():
+            content = DumpConfig(data, fmt=fmt)
+            sections[name] = (content, ContentHash(content))
+        return sections
 
 
 def get_demo_jpa_flow():
@@ -414,8 +686,7 @@ def get_demo_jpa_flow():
 
 if __name__ == '__main__':
     pipeline = OnlineGenerator(configure=get_demo_jpa_flow())
-    compose_content = pipeline.gen_docker_compose()
-    docker_compose = open("docker_compose.yml", "w")
-    docker_compose.write(compose_content)
-    docker_compose.close()
+    with open("docker_compose.yml", "w") as docker_compose:
+        pipeline.gen_docker_compose(stream=docker_compose)
     putServiceConfig(pipeline.gen_server_config())
+    putServiceConfigSections(pipeline.gen_server_config_sections())
@@ -0,0 +1,167 @@
+#
+# Copyright 2022 DMetaSoul
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import socket
+import subprocess
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from attrs import asdict, frozen, field
+
+
+@frozen
+class ServiceStatus(object):
+    name: str
+    container: str
+    state: str
+    ports: dict
+    ready: bool
+    probe_ms: float
+    config_version: str = None
+    error: str = None
+
+
+@frozen
+class StatusReport(object):
+    services: dict
+    ready: bool
+    config_version: str = None
+    time_to_ready: dict = field(factory=dict)
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def probe_tcp(host, port, timeout=1.0):
+    try:
+        with socket.create_connection((host, int(port)), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def probe_http(host, port, path, timeout=1.0):
+    """GET an http health endpoint, a spring actuator body must report status UP"""
+    try:
+        with urllib.request.urlopen("http://%s:%s%s" % (host, port, path), timeout=timeout) as response:
+            body = response.read()
+    except (OSError, ValueError):
+        return False
+    try:
+        status = json.loads(body).get("status")
+    except (ValueError, AttributeError):
+        return True
+    return status is None or status == "UP"
+
+
+def docker_container_state(container_name):
+    """return running, healthy, unhealthy, starting, exited... or missing when the container does not exist"""
+    ret = subprocess.run(["docker", "inspect", "-f", "{{.State.Status}} {{if .State.Health}}{{.State.Health.Status}}"
+                                                     "{{end}}", container_name],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8")
+    if ret.returncode != 0:
+        return "missing"
+    status = ret.stdout.split()
+    if len(status) > 1 and status[0] == "running":
+        return status[1]
+    return status[0] if status else "missing"
+
+
+READY_STATES = ("running", "healthy")
+
+
+def compose_endpoints(online_docker_compose):
+    """ports to probe per compose service, taken from the <NAME>_HOST/<NAME>_PORT pairs injected into recommend"""
+    endpoints = dict()
+    recommend = online_docker_compose.services.get("recommend")
+    if recommend is not None and not recommend.environment:
+        # recommend replicas behind a load balancer
+        recommend = online_docker_compose.services.get("recommend_1")
+    environment = recommend.environment if recommend else {}
+    for name in online_docker_compose.services:
+        port = environment.get("%s_PORT" % name.upper())
+        if port is not None and environment.get("%s_HOST" % name.upper()) == name:
+            endpoints[name] = [port]
+        else:
+            endpoints[name] = list(online_docker_compose.services[name].ports or [])
+    return endpoints
+
+
+class HealthProber(object):
+    """
+    probe every compose service concurrently: container state and tcp reachability of its ports.
+    health_paths adds an http check per service, e.g. {"recommend": "/actuator/health"} when it is exposed.
+    the recommend config version is only compared when a version_probe and expected_version are given,
+    which needs the deployment to publish the version it has loaded.
+    container_probe and the host map can be replaced to run against local socket stand-ins.
+    """
+
+    def __init__(self, online_docker_compose, hosts=None, container_probe=None, version_probe=None,
+                 expected_version=None, timeout=1.0, health_paths=None):
+        self.services = online_docker_compose.services
+        self.endpoints = compose_endpoints(online_docker_compose)
+        self.hosts = hosts or {}
+        self.container_probe = container_probe or docker_container_state
+        self.version_probe = version_probe
+        self.expected_version = expected_version
+        self.timeout = timeout
+        self.health_paths = health_paths or {}
+
+    def probe_service(self, name):
+        start = time.perf_counter()
+        service = self.services[name]
+        error = None
+        ports = dict()
+        config_version = None
+        try:
+            state = self.container_probe(service.container_name)
+            host = self.hosts.get(name, self.hosts.get("default", "localhost"))
+            for port in self.endpoints.get(name, []):
+                ports[str(port)] = probe_tcp(host, port, self.timeout)
+            ready = state in READY_STATES and all(ports.values())
+            path = self.health_paths.get(name)
+            if ready and path and ports:
+                ready = probe_http(host, next(iter(ports)), path, self.timeout)
+            if name == "recommend" and self.version_probe is not None and self.expected_version:
+                config_version = self.version_probe()
+                ready = ready and config_version == self.expected_version
+        except Exception as ex:
+            state = "unknown"
+            ready = False
+            error = str(ex)
+        return ServiceStatus(name, service.container_name, state, ports, ready,
+                             (time.perf_counter() - start) * 1000.0, config_version, error)
+
+    def probe_all(self):
+        with ThreadPoolExecutor(max_workers=max(len(self.services), 1)) as pool:
+            statuses = list(pool.map(self.probe_service, list(self.services.keys())))
+        services = {status.name: status for status in statuses}
+        return StatusReport(services, all(status.ready for status in statuses), self.expected_version)
+
+    def wait_ready(self, timeout=120, interval=1.0):
+        """probe until every service is ready or timeout, time_to_ready holds seconds since start per service"""
+        start = time.monotonic()
+        time_to_ready = dict()
+        while True:
+            report = self.probe_all()
+            elapsed = time.monotonic() - start
+            for name, status in report.services.items():
+                if status.ready and name not in time_to_ready:
+                    time_to_ready[name] = elapsed
+            if report.ready or elapsed >= timeout:
+                return StatusReport(report.services, report.ready, report.config_version, time_to_ready)
+            time.sleep(interval)
@@ -0,0 +1,1000 @@
+#
+# Copyright 2022 DMetaSoul
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import itertools
+import json
+import operator
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from online_flow import OnlineFlow
+
+REQUEST_ID = "__request__"
+
+SCALAR_DTYPES = {
+    "str": np.str_, "string": np.str_,
+    "int": np.int64, "long": np.int64,
+    "double": np.float64, "float": np.float64, "decimal": np.float64,
+}
+
+
+def object_array(values, size=None):
+    if isinstance(values, np.ndarray):
+        return values
+    if size is None:
+        values = list(values)
+        size = len(values)
+    return np.fromiter(values, dtype=object, count=size)
+
+
+def column_array(values):
+    """typed column: unicode for strings, int64 or float64 for numbers, object for nulls, mixed or nested values"""
+    if isinstance(values, np.ndarray):
+        return values
+    values = values if isinstance(values, list) else list(values)
+    kinds = set(map(type, values))
+    try:
+        if kinds == {str}:
+            return np.array(values, dtype=np.str_)
+        if kinds == {int}:
+            return np.array(values, dtype=np.int64)
+        if kinds == {float}:
+            return np.array(values, dtype=np.float64)
+    except OverflowError:
+        pass
+    return object_array(values, len(values))
+
+
+def as_object(values):
+    if values.ndim > 1:
+        return object_array(list(values), len(values))
+    return values.astype(object)
+
+
+def null_mask(values):
+    if values.dtype == object:
+        return np.equal(values, None)
+    return np.zeros(len(values), dtype=bool)
+
+
+def float_array(values, default=0.0):
+    if values.dtype != object:
+        return values.astype(np.float64)
+    values = values.copy()
+    values[null_mask(values)] = default
+    return values.astype(np.float64)
+
+
+def string_array(values, null=""):
+    if values.dtype.kind == "U":
+        return values
+    if values.ndim > 1:
+        values = object_array(values.tolist(), len(values))
+    strings = values.astype(np.str_)
+    nulls = null_mask(values)
+    return np.where(nulls, null, strings) if nulls.any() else strings
+
+
+def cast_array(values, kind):
+    """cast a column to a sourceTable or typeTransform scalar type, nulls stay None"""
+    dtype = SCALAR_DTYPES.get(str(kind).lower()) if isinstance(kind, str) else None
+    if dtype is None:
+        return values
+    nulls = null_mask(values)
+    if not nulls.any():
+        return values.astype(dtype)
+    result = np.full(len(values), None, dtype=object)
+    result[~nulls] = values[~nulls].astype(dtype).astype(object)
+    return result
+
+
+def key_array(values, strings=False):
+    """(sortable keys, null mask) of a join or group column, numbers stay numbers unless strings is set"""
+    if not strings and values.dtype.kind in "iufb":
+        return values, np.zeros(len(values), dtype=bool)
+    return string_array(values), null_mask(values)
+
+
+def group_starts(sorted_codes):
+    """start offset of every run of equal codes in a sorted code array"""
+    if len(sorted_codes) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate([[True], sorted_codes[1:] != sorted_codes[:-1]]))
+
+
+def rank_in_groups(sorted_codes):
+    """0 based position of every row in its run of equal codes"""
+    starts = group_starts(sorted_codes)
+    sizes = np.diff(np.append(starts, len(sorted_codes)))
+    return np.arange(len(sorted_codes), dtype=np.int64) - np.repeat(starts, sizes)
+
+
+def group_codes(columns, size):
+    """dense codes of the distinct key tuples of the rows, a null key is a group of its own"""
+    codes = np.zeros(size, dtype=np.int64)
+    for values in columns:
+        keys, nulls = key_array(values)
+        uniques, inverse = np.unique(keys, return_inverse=True)
+        inverse = np.where(nulls, len(uniques), inverse.reshape(-1))
+        _, codes = np.unique(codes * (len(uniques) + 1) + inverse, return_inverse=True)
+        codes = codes.reshape(-1)
+    return codes
+
+
+def value_hashes(prefix, values):
+    """crc32 of "<prefix>:<value>" of every row as float64, computed once per distinct value"""
+    uniques, inverse = np.unique(string_array(values, "None"), return_inverse=True)
+    hashes = np.fromiter((zlib.crc32(("%s:%s" % (prefix, value)).encode("utf-8")) for value in uniques.tolist()),
+                         dtype=np.float64, count=len(uniques))
+    return hashes, inverse.reshape(-1)
+
+
+class Frame(object):
+    """column oriented batch of rows, every column is a numpy array of the same length"""
+
+    def __init__(self, columns=None, size=0):
+        self.columns = dict()
+        self.size = size
+        for name, values in (columns or {}).items():
+            self.set_column(name, values)
+
+    @staticmethod
+    def from_rows(rows, columns=None):
+        rows = list(rows)
+        if columns is None:
+            columns = list()
+            for row in rows:
+                columns.extend([name for name in row.keys() if name not in columns])
+        return Frame({name: column_array(list(map(operator.methodcaller("get", name), rows)))
+                      for name in columns}, len(rows))
+
+    def set_column(self, name, values):
+        values = column_array(values)
+        if not self.columns and not self.size:
+            self.size = len(values)
+        if len(values) != self.size:
+            raise ValueError("frame column %s size %d mismatch frame size %d!" % (name, len(values), self.size))
+        self.columns[name] = values
+
+    def column(self, name):
+        if name not in self.columns:
+            raise ValueError("frame has no column: %s" % name)
+        return self.columns[name]
+
+    def take(self, index):
+        return Frame({name: values[index] for name, values in self.columns.items()}, len(index))
+
+    def select(self, names):
+        return Frame({name: self.columns[name] for name in names if name in self.columns}, self.size)
+
+    def to_rows(self):
+        names = list(self.columns.keys())
+        return [dict(zip(names, values)) for values in zip(*[self.columns[name].tolist() for name in names])] \
+            if names else [dict() for _ in range(self.size)]
+
+
+def concat_frames(frames):
+    frames = [frame for frame in frames if frame is not None]
+    if not frames:
+        return Frame()
+    names = list()
+    for frame in frames:
+        names.extend([name for name in frame.columns if name not in names])
+    size = sum(frame.size for frame in frames)
+    columns = dict()
+    for name in names:
+        parts = [frame.columns[name] if name in frame.columns else np.full(frame.size, None, dtype=object)
+                 for frame in frames]
+        kinds = {part.dtype.kind for part in parts}
+        # numbers promote among themselves, anything else mixed is concatenated as python objects
+        if len({part.ndim for part in parts}) > 1 or (len(kinds) > 1 and not kinds <= set("iuf")):
+            parts = [as_object(part) for part in parts]
+        columns[name] = np.concatenate(parts)
+    return Frame(columns, size)
+
+
+class MemoryTable(Frame):
+    """an in-memory stand-in for one collection, sorted key indexes are built lazily per key column"""
+
+    def __init__(self, columns=None, size=0):
+        super().__init__(columns, size)
+        self._indexes = dict()
+
+    @staticmethod
+    def from_rows(rows, columns=None):
+        frame = Frame.from_rows(rows, columns)
+        return MemoryTable(frame.columns, frame.size)
+
+    @staticmethod
+    def from_json(path):
+        """load a json array or json lines file, mongo export _id fields are dropped"""
+        with open(path, encoding="utf-8") as json_file:
+            head = json_file.read(1)
+            while head and head.isspace():
+                head = json_file.read(1)
+            json_file.seek(0)
+            if head == "[":
+                rows = json.load(json_file)
+            else:
+                rows = [json.loads(line) for line in json_file if line.strip()]
+        table = MemoryTable.from_rows(rows)
+        table.columns.pop("_id", None)
+        return table
+
+    @staticmethod
+    def from_collection(collection, query=None):
+        """load from a pymongo or mongomock collection"""
+        return MemoryTable.from_rows(collection.find(query or {}, {"_id": False}))
+
+    def cast_columns(self, columns):
+        for column in columns or []:
+            if not isinstance(column, dict):
+                continue
+            for name, kind in column.items():
+                if name in self.columns:
+                    self.columns[name] = cast_array(self.columns[name], kind)
+        self._indexes.clear()
+
+    def index(self, name, strings=False):
+        """(sorted keys, their row positions) of a key column without its null keys"""
+        index = self._indexes.get((name, strings))
+        if index is None:
+            keys, nulls = key_array(self.column(name), strings)
+            order = np.argsort(keys, kind="stable")
+            order = order[~nulls[order]]
+            index = (keys[order], order)
+            self._indexes[(name, strings)] = index
+        return index
+
+
+def sorted_join(left_keys, left_nulls, sorted_keys, order, keep_missing):
+    """
+    (left positions, right positions) of the rows of sorted_keys matching every left key, in left order
+    and right order within a key. right position -1 marks a missing match kept for a left join.
+    """
+    starts = np.searchsorted(sorted_keys, left_keys, side="left")
+    counts = np.where(left_nulls, 0, np.searchsorted(sorted_keys, left_keys, side="right") - starts)
+    missing = (counts == 0) if keep_missing else np.zeros(len(counts), dtype=bool)
+    sizes = np.where(missing, 1, counts)
+    left = np.repeat(np.arange(len(left_keys), dtype=np.int64), sizes)
+    # the i-th match of a left row is order[start + i]
+    offsets = np.arange(len(left), dtype=np.int64) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    positions = np.repeat(starts, sizes) + offsets
+    found = ~np.repeat(missing, sizes)
+    right = np.full(len(left), -1, dtype=np.int64)
+    right[found] = order[positions[found]]
+    return left, right
+
+
+def lookup_join(left_keys, table, key, keep_missing):
+    """return (left positions, right positions) of a sort merge join, right position -1 marks a missing match"""
+    strings = left_keys.dtype.kind not in "iufb" or table.column(key).dtype.kind not in "iufb"
+    keys, nulls = key_array(left_keys, strings)
+    sorted_keys, order = table.index(key, strings)
+    return sorted_join(keys, nulls, sorted_keys, order, keep_missing)
+
+
+def take_with_missing(values, positions):
+    found = positions >= 0
+    if found.all():
+        return values[positions]
+    result = np.full(len(positions), None, dtype=object)
+    result[found] = as_object(values[positions[found]])
+    return result
+
+
+def split_ref(ref):
+    table, _, column = str(ref).partition(".")
+    if not column:
+        return None, table
+    return table, column
+
+
+def default_scorer(model_name, columns, size):
+    """deterministic stand-in for predictScore, hash every row of the model input columns into [0, 1)"""
+    scores = np.zeros(size, dtype=np.float64)
+    for name in sorted(columns):
+        hashes, inverse = value_hashes(name, columns[name])
+        scores = (scores + hashes[inverse] / 4294967296.0) % 1.0
+    return scores
+
+
+def default_embedder(model_name, columns, size, dim=16):
+    """deterministic stand-in for predictEmbedding, hash every row of the model input columns into a unit vector"""
+    vectors = np.zeros((size, dim), dtype=np.float32)
+    for name in sorted(columns):
+        hashes, inverse = value_hashes("%s:%s" % (model_name, name), columns[name])
+        table = np.stack([np.random.default_rng(int(seed)).standard_normal(dim) for seed in hashes]) \
+            if len(hashes) else np.zeros((0, dim))
+        vectors += table[inverse]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+
+def merge_scores(origin, name, scores, size):
+    """origin_scores maps of the rows with scores added under name, origin may be None"""
+    origin = origin.tolist() if origin is not None else [None] * size
+    return object_array((dict(merged or {}, **{name: score}) for merged, score in zip(origin, scores.tolist())),
+                        size)
+
+
+def neighbor_columns(neighbors):
+    """(items, float scores) of (item, score) pairs or {item field: item, score field: score} documents"""
+    first = neighbors[0] if neighbors else None
+    if isinstance(first, dict) and len(first) > 1:
+        item_field, score_field = list(first.keys())[:2]
+        try:
+            return column_array(list(map(operator.itemgetter(item_field), neighbors))), \
+                np.array(list(map(operator.itemgetter(score_field), neighbors)), dtype=np.float64)
+        except (KeyError, TypeError):
+            pass
+    items = list()
+    scores = list()
+    for neighbor in neighbors:
+        if isinstance(neighbor, dict):
+            values = list(neighbor.values())
+            items.append(values[0])
+            scores.append(values[1] if len(values) > 1 else 1.0)
+        else:
+            items.append(neighbor[0])
+            scores.append(neighbor[1])
+    return column_array(items), np.array(scores, dtype=np.float64)
+
+
+def limit_per_request(frame, limit, order_field=None):
+    """keep the first limit rows of every request, by descending order_field when it is a column"""
+    if not limit or frame.size == 0:
+        return frame
+    requests = group_codes([frame.column(REQUEST_ID)], frame.size)
+    positions = np.arange(frame.size, dtype=np.int64)
+    scores = frame.columns.get(order_field) if order_field else None
+    if scores is None:
+        order = np.lexsort((positions, requests))
+    else:
+        order = np.lexsort((positions, -float_array(scores), requests))
+    keep = order[rank_in_groups(requests[order]) < limit]
+    return frame.take(np.sort(keep) if scores is None else keep)
+
+
+class FieldActionRunner(object):
+    """vectorized implementation of the field action funcs emitted by OnlineGenerator"""
+
+    def __init__(self, executor):
+        self.executor = executor
+
+    def run(self, frame, action, options):
+        func = getattr(self, "func_%s" % action.func, None)
+        if func is None:
+            raise ValueError("reference executor not support field action func: %s" % action.func)
+        index, columns = func(frame, action, options or {})
+        if index is not None:
+            frame = frame.take(index)
+        for name, values in columns.items():
+            frame.set_column(name, values)
+        return frame
+
+    @staticmethod
+    def func_typeTransform(frame, action, options):
+        return None, {name: cast_array(frame.column(field), kind)
+                      for name, field, kind in zip(action.names, action.fields, action.types)}
+
+    @staticmethod
+    def func_splitRecentIds(frame, action, options):
+        splitor = (action.options or {}).get("splitor", "\u0001")
+        values = string_array(frame.column(action.fields[0]))
+        return None, {action.names[0]: object_array(
+            (list(filter(None, items)) for items in np.char.split(values, splitor).tolist()), frame.size)}
+
+    @staticmethod
+    def func_recentWeight(frame, action, options):
+        item_ids = frame.column(action.input[0])
+        counts = np.fromiter(map(len, item_ids), dtype=np.int64, count=frame.size)
+        index = np.repeat(np.arange(frame.size, dtype=np.int64), counts)
+        items = column_array(list(itertools.chain.from_iterable(item_ids)))
+        # the weight of an id is 1 / (1 + its position in the sequence of its row)
+        ranks = np.arange(len(index), dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+        return index, {action.names[0]: items, action.names[1]: 1.0 / (1.0 + ranks)}
+
+    def func_randomGenerator(self, frame, action, options):
+        bound = (action.options or {}).get("bound", 10)
+        return None, {action.names[0]: self.executor.random.integers(0, bound, frame.size)}
+
+    @staticmethod
+    def func_setValue(frame, action, options):
+        value = (action.options or {}).get("value")
+        return None, {action.names[0]: column_array([value] * frame.size)}
+
+    @staticmethod
+    def func_concatField(frame, action, options):
+        join = (action.options or {}).get("join", "#")
+        values = None
+        for field in action.fields:
+            part = string_array(frame.column(field))
+            values = part if values is None else np.char.add(np.char.add(values, join), part)
+        return None, {action.names[0]: values if values is not None else np.full(frame.size, "", dtype=np.str_)}
+
+    @staticmethod
+    def func_toItemScore(frame, action, options):
+        user_field, value_field, score_field = action.fields
+        users = frame.column(user_field)
+        neighbors = frame.column(value_field)
+        groups = group_codes([frame.column(REQUEST_ID), users], frame.size)
+        # one output row per (request, user), at its first position
+        _, firsts = np.unique(groups, return_index=True)
+        counts = np.fromiter((len(neighbor or []) for neighbor in neighbors), dtype=np.int64, count=frame.size)
+        rows = np.repeat(np.arange(frame.size, dtype=np.int64), counts)
+        flat = list(itertools.chain.from_iterable(neighbor or [] for neighbor in neighbors))
+        items, scores = neighbor_columns(flat)
+        scores = scores * float_array(frame.column(score_field), 1.0)[rows]
+        # the best score of an item per group, items keep the order they first appear in
+        pair_groups = groups[rows]
+        pairs = group_codes([pair_groups, items], len(rows))
+        best = np.full(int(pairs.max()) + 1 if len(pairs) else 0, -np.inf)
+        np.maximum.at(best, pairs, scores)
+        _, pair_firsts = np.unique(pairs, return_index=True)
+        pair_firsts = pair_firsts[np.lexsort((pair_firsts, pair_groups[pair_firsts]))]
+        item_scores = [dict() for _ in range(len(firsts))]
+        group_items = pair_groups[pair_firsts]
+        starts = group_starts(group_items)
+        for start, end in zip(starts.tolist(), np.append(starts[1:], len(pair_firsts)).tolist()):
+            positions = pair_firsts[start:end]
+            item_scores[int(group_items[start])] = dict(zip(items[positions].tolist(),
+                                                            best[pairs[positions]].tolist()))
+        order = np.argsort(firsts, kind="stable")
+        index = firsts[order]
+        return index, {action.names[0]: users[index],
+                       action.names[1]: object_array([item_scores[group] for group in order.tolist()], len(index))}
+
+    @staticmethod
+    def func_recallCollectItem(frame, action, options):
+        users = frame.column(action.input[0])
+        item_scores = frame.column(action.input[1])
+        algo_name = options.get("algo-name", "recall")
+        counts = np.fromiter(map(len, item_scores), dtype=np.int64, count=frame.size)
+        index = np.repeat(np.arange(frame.size, dtype=np.int64), counts)
+        items = column_array(list(itertools.chain.from_iterable(map(dict.keys, item_scores))))
+        scores = np.fromiter(itertools.chain.from_iterable(map(dict.values, item_scores)), dtype=np.float64,
+                             count=len(index))
+        return index, {action.names[0]: users[index], action.names[1]: items, action.names[2]: scores,
+                       action.names[3]: object_array(({algo_name: score} for score in scores.tolist()), len(index))}
+
+    def func_predictScore(self, frame, action, options):
+        names = list(action.input or [])
+        for column_info in action.algoColumns or []:
+            for columns in column_info.values():
+                names.extend([name for name in columns if name not in names])
+        columns = {name: frame.column(name) for name in names if name in frame.columns}
+        model_name = (action.options or {}).get("modelName")
+        scores = self.executor.scorer(model_name, columns, frame.size)
+        return None, {action.names[0]: np.asarray(scores, dtype=np.float64)}
+
+    def func_predictEmbedding(self, frame, action, options):
+        names = list(action.input or [])
+        for column_info in action.algoColumns or []:
+            for columns in column_info.values():
+                names.extend([name for name in columns if name not in names])
+        columns = {name: frame.column(name) for name in names if name in frame.columns}
+        model_name = (action.options or {}).get("modelName")
+        # a float32 matrix column, one embedding per row
+        return None, {action.names[0]: np.asarray(self.executor.embedder(model_name, columns, frame.size),
+                                                  dtype=np.float32)}
+
+    def func_milvusSearch(self, frame, action, options):
+        search = action.options or {}
+        collection = search.get("collectionName")
+        index = self.executor.ann_indexes.get(collection)
+        if index is None:
+            raise ValueError("reference executor has no ann index for milvus collection: %s" % collection)
+        users = frame.column(action.input[0])
+        algo_name = options.get("algo-name", "recall")
+        vectors = frame.column(action.input[1])
+        if vectors.ndim < 2:
+            vectors = np.asarray(vectors.tolist(), dtype=np.float32).reshape(frame.size, -1)
+        results = index.search(vectors, search.get("topK", 200), **(search.get("searchParams") or {}))
+        counts = np.fromiter((len(ids) for ids, _ in results), dtype=np.int64, count=frame.size)
+        positions = np.repeat(np.arange(frame.size, dtype=np.int64), counts)
+        size = int(counts.sum())
+        # milvus returns l2 distances, smaller is closer, recall scores are larger is better
+        sign = -1.0 if search.get("metricType") == "L2" else 1.0
+        items = column_array(list(itertools.chain.from_iterable(ids for ids, _ in results)))
+        scores = sign * np.fromiter(itertools.chain.from_iterable(distances for _, distances in results),
+                                    dtype=np.float64, count=size)
+        return positions, {action.names[0]: users[positions], action.names[1]: items, action.names[2]: scores,
+                           action.names[3]: object_array(({algo_name: score} for score in scores.tolist()), size)}
+
+    @staticmethod
+    def func_rankCollectItem(frame, action, options):
+        items = frame.column(action.input[0])
+        scores = frame.column(action.input[1])
+        algo_name = options.get("algo-name", "rank")
+        origin = frame.columns.get(action.fields[0]) if action.fields else None
+        return None, {action.names[0]: items, action.names[1]: scores,
+                      action.names[2]: merge_scores(origin, algo_name, scores, frame.size)}
+
+
+class InjectedFault(Exception):
+    pass
+
+
+class FaultInjector(object):
+    """
+    simulated stage faults for the reference executor: delays_ms is added to the measured stage time
+    without sleeping, error_rates makes a stage raise InjectedFault with that probability.
+    """
+
+    def __init__(self, delays_ms=None, error_rates=None, seed=0):
+        self.delays_ms = dict(delays_ms or {})
+        self.error_rates = dict(error_rates or {})
+        self.random = np.random.default_rng(seed)
+
+    def inject(self, stage):
+        """return the injected delay of the stage in ms or raise InjectedFault"""
+        rate = self.error_rates.get(stage, 0.0)
+        if rate > 0 and self.random.random() < rate:
+            raise InjectedFault("injected fault in %s" % stage)
+        return float(self.delays_ms.get(stage, 0.0))
+
+
+class CircuitBreaker(object):
+    """closed -> open after failure_threshold consecutive failures, half open after open_ms"""
+
+    def __init__(self, failure_threshold=5, open_ms=10000, half_open_calls=1, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.open_ms = open_ms
+        self.half_open_calls = half_open_calls
+        self.clock = clock
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_calls = 0
+
+    def allow(self):
+        if self.state == "open":
+            if (self.clock() - self.opened_at) * 1000.0 < self.open_ms:
+                return False
+            self.state = "half_open"
+            self.trial_calls = 0
+        if self.state == "half_open":
+            if self.trial_calls >= self.half_open_calls:
+                return False
+            self.trial_calls += 1
+        return True
+
+    def success(self):
+        self.state = "closed"
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = self.clock()
+
+
+class ResultCache(object):
+    """in process lru with ttl, stand-in of the scene resultCache for both local and redis backends"""
+
+    def __init__(self, max_entries=10000, ttl=30, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > self.clock():
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+        if entry is not None:
+            del self.entries[key]
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key, value):
+        self.entries[key] = (self.clock() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def hit_rate(self):
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+
+class ReferenceExecutor(object):
+    """
+    execute a generated OnlineServiceConfig in process over MemoryTable data.
+    tables are keyed by sourceTable name or by the physical table name of the sourceTable.
+    ann_indexes are keyed by milvus collection name, see ann_index.new_ann_index.
+    faults injects stage delays and errors to exercise the chain fallbacks of the config.
+    """
+
+    def __init__(self, server_config, tables, scorer=None, seed=0, embedder=None, ann_indexes=None, faults=None,
+                 clock=time.monotonic):
+        if isinstance(server_config, OnlineFlow):
+            from online_generator import OnlineGenerator
+            server_config = OnlineGenerator(configure=server_config).build_server_config()
+        feature_config = server_config.feature_service
+        recommend_config = server_config.recommend_service
+        self.sources = {item.name: item for item in feature_config.source}
+        self.source_tables = {item.name: item for item in feature_config.sourceTable}
+        self.features = {item.name: item for item in feature_config.feature}
+        self.algo_transforms = {item.name: item for item in feature_config.algoTransform}
+        self.services = {item.name: item for item in recommend_config.services}
+        self.experiments = {item.name: item for item in recommend_config.experiments}
+        self.layers = {item.name: item for item in recommend_config.layers}
+        self.scenes = {item.name: item for item in recommend_config.scenes}
+        self.scorer = scorer or default_scorer
+        self.embedder = embedder or default_embedder
+        self.ann_indexes = dict(ann_indexes or {})
+        self.faults = faults
+        self.clock = clock
+        self.breakers = dict()
+        self.fallback_stats = dict()
+        self.result_caches = dict()
+        self.random = np.random.default_rng(seed)
+        self.runner = FieldActionRunner(self)
+        self.tables = dict()
+        self.stats = dict()
+        for name, source_table in self.source_tables.items():
+            table = tables.get(name)
+            if table is None and source_table.table:
+                table = tables.get(source_table.table)
+            if table is None:
+                continue
+            if not isinstance(table, MemoryTable):
+                table = MemoryTable.from_rows(table)
+            table.cast_columns(source_table.columns)
+            self.tables[name] = table
+
+    def record(self, name, start):
+        total, count = self.stats.get(name, (0.0, 0))
+        self.stats[name] = (total + time.perf_counter() - start, count + 1)
+
+    def is_request_table(self, name):
+        source_table = self.source_tables.get(name)
+        if source_table is None:
+            return False
+        source = self.sources.get(source_table.source)
+        return source is None or source.kind == "Request"
+
+    def qualified(self, name, frame):
+        columns = {"%s.%s" % (name, column): values for column, values in frame.columns.items()
+                   if column != REQUEST_ID}
+        columns[REQUEST_ID] = frame.column(REQUEST_ID)
+        return Frame(columns, frame.size)
+
+    def node_frame(self, name, context):
+        if name in context:
+            return context[name]
+        start = time.perf_counter()
+        if name in self.features:
+            frame = self.run_feature(self.features[name], context)
+        elif name in self.algo_transforms:
+            frame = self.run_algo_transform(self.algo_transforms[name], context)
+        else:
+            raise ValueError("reference executor can not resolve table: %s" % name)
+        self.record(name, start)
+        context[name] = frame
+        return frame
+
+    def merge_on_request(self, frames):
+        merged = frames[0]
+        for frame in frames[1:]:
+            requests = frame.column(REQUEST_ID)
+            order = np.argsort(requests, kind="stable")
+            left, right = sorted_join(merged.column(REQUEST_ID), np.zeros(merged.size, dtype=bool),
+                                      requests[order], order, False)
+            combined = merged.take(left)
+            for column, values in frame.columns.items():
+                if column != REQUEST_ID:
+                    combined.set_column(column, values[right])
+            merged = combined
+        return merged
+
+    def run_feature(self, feature, context):
+        drivers = list()
+        lookups = set()
+        for depend in feature.depend:
+            if depend in self.tables and not self.is_request_table(depend):
+                lookups.add(depend)
+            elif depend in self.source_tables and not self.is_request_table(depend):
+                raise ValueError("reference executor has no data for sourceTable: %s" % depend)
+            else:
+                drivers.append(self.qualified(depend, self.node_frame(depend, context)))
+        if not drivers:
+            raise ValueError("feature %s has no request, algoTransform or candidate input!" % feature.name)
+        joined = self.merge_on_request(drivers)
+        joined_tables = set(depend for depend in feature.depend if depend not in lookups)
+        pending = list(feature.condition or [])
+        while pending:
+            progress = False
+            for condition in list(pending):
+                left_table, left_column = split_ref(condition.left)
+                right_table, right_column = split_ref(condition.right)
+                keep_missing = condition.type in ("left", "full")
+                if left_table in joined_tables and right_table in joined_tables:
+                    mask = joined.column(condition.left) == joined.column(condition.right)
+                    joined = joined.take(np.flatnonzero(mask))
+                elif left_table in joined_tables or right_table in joined_tables:
+                    if right_table in joined_tables:
+                        left_table, left_column, right_table, right_column = \
+                            right_table, right_column, left_table, left_column
+                    table = self.tables[right_table]
+                    left, right = lookup_join(joined.column("%s.%s" % (left_table, left_column)), table,
+                                              right_column, keep_missing)
+                    combined = joined.take(left)
+                    for column, values in table.columns.items():
+                        combined.set_column("%s.%s" % (right_table, column), take_with_missing(values, right))
+                    joined = combined
+                    joined_tables.add(right_table)
+                else:
+                    continue
+                pending.remove(condition)
+                progress = True
+            if not progress:
+                raise ValueError("feature %s conditions can not be joined!" % feature.name)
+        columns = {REQUEST_ID: joined.column(REQUEST_ID)}
+        for ref in feature.select:
+            table, column = split_ref(ref)
+            if table is None:
+                matches = [name for name in joined.columns if name.endswith(".%s" % column)]
+                if not matches:
+                    raise ValueError("feature %s select %s not found!" % (feature.name, ref))
+                ref = matches[0]
+            columns[column] = joined.columns[ref] if ref in joined.columns else \
+                np.full(joined.size, None, dtype=object)
+        return Frame(columns, joined.size)
+
+    def run_algo_transform(self, algo_transform, context):
+        inputs = [self.node_frame(name, context)
+                  for name in list(algo_transform.feature or []) + list(algo_transform.algoTransform or [])]
+        if inputs:
+            frame = self.merge_on_request(inputs) if len(inputs) > 1 else inputs[0].take(np.arange(inputs[0].size))
+        else:
+            frame = context["__requests__"].select([REQUEST_ID])
+        pending = list(algo_transform.fieldActions or [])
+        while pending:
+            runnable = [action for action in pending
+                        if all(name in frame.columns for name in (action.input or []))]
+            if not runnable:
+                raise ValueError("algoTransform %s field actions input can not be resolved!" % algo_transform.name)
+            for action in runnable:
+                frame = self.runner.run(frame, action, algo_transform.options)
+                pending.remove(action)
+        return frame.select([REQUEST_ID] + list(algo_transform.output or []))
+
+    def apply_transforms(self, frame, transforms, options, stage):
+        limit = (options or {}).get("maxReservation")
+        for transform in transforms or []:
+            option = transform.option or {}
+            if transform.name == "cutOff":
+                frame = limit_per_request(frame, limit, "score")
+            elif transform.name == "orderAndLimit":
+                order_fields = option.get("orderFields") or ["score"]
+                frame = limit_per_request(frame, limit, order_fields[0])
+            elif transform.name == "summaryBySchema":
+                frame = self.summary_by_schema(frame, option)
+            elif transform.name == "updateField":
+                if option.get("updateOperator") == "putOriginScores" and "origin_scores" in frame.columns:
+                    frame.set_column("origin_scores", merge_scores(frame.column("origin_scores"), stage,
+                                                                   frame.column("score"), frame.size))
+        return frame
+
+    @staticmethod
+    def summary_by_schema(frame, option):
+        dup_fields = option.get("dupFields") or []
+        operators = option.get("mergeOperator") or {}
+        if frame.size == 0:
+            return frame
+        codes = group_codes([frame.column(REQUEST_ID)] + [frame.column(name) for name in dup_fields], frame.size)
+        order = np.argsort(codes, kind="stable")
+        starts = group_starts(codes[order])
+        ends = np.append(starts[1:], frame.size)
+        firsts = order[starts]
+        for name, merge_operator in operators.items():
+            if name not in frame.columns:
+                continue
+            values = frame.columns[name].copy()
+            if merge_operator == "maxScore":
+                best = np.maximum.reduceat(float_array(values)[order], starts)
+                values[firsts] = best if values.dtype != object else best.astype(object)
+            elif merge_operator == "mergeScoreInfo":
+                # only groups with duplicates merge their score maps
+                for group in np.flatnonzero(ends - starts > 1).tolist():
+                    merged = dict()
+                    for position in order[starts[group]:ends[group]].tolist():
+                        merged.update(values[position] or {})
+                    values[firsts[group]] = merged
+            frame.columns[name] = values
+        return frame.take(np.sort(firsts))
+
+    def run_service(self, name, frame, requests):
+        start = time.perf_counter()
+        service = self.services[name]
+        context = {"__requests__": requests, name: frame}
+        for table in self.source_tables:
+            if self.is_request_table(table):
+                context[table] = requests
+        outputs = [self.node_frame(task, context) for task in service.tasks or []]
+        result = concat_frames(outputs)
+        result = limit_per_request(result, (service.options or {}).get("maxReservation"),
+                                   "score" if "score" in result.columns else None)
+        result = self.apply_transforms(result, service.transforms, service.options, name)
+        self.record(name, start)
+        return result
+
+    def run_step(self, name, frame, requests):
+        if name in self.services:
+            return self.run_service(name, frame, requests)
+        if name in self.experiments:
+            experiment = self.experiments[name]
+            return self.run_chains(name, experiment.chains, experiment.options, frame, requests)
+        if name in self.layers:
+            return self.run_layer(self.layers[name], frame, requests)
+        raise ValueError("chain step %s is not a service, experiment or layer!" % name)
+
+    def count_fallback(self, step, reason):
+        stats = self.fallback_stats.setdefault(step, {"calls": 0, "timeouts": 0, "errors": 0, "rejected": 0})
+        stats[reason] += 1
+
+    def run_fallback(self, step, option, frame, requests, reason):
+        self.count_fallback(step, reason)
+        mode = option.get("onFallback", "substitute")
+        if mode == "passThrough":
+            return frame
+        if mode == "drop":
+            return Frame({REQUEST_ID: np.empty(0, dtype=np.int64)}, 0)
+        result = frame
+        for name in option.get("fallback") or []:
+            result = self.run_step(name, result, requests)
+        return result
+
+    def run_guarded(self, step, frame, requests, fallbacks):
+        """run a chain step under its fallback option: timeout, circuit breaker and fallback steps"""
+        option = fallbacks.get(step)
+        if option is None:
+            return self.run_step(step, frame, requests)
+        breaker = self.breakers.get(step)
+        if breaker is None:
+            breaker = CircuitBreaker(option.get("failureThreshold", 5), option.get("openMs", 10000),
+                                     option.get("halfOpenCalls", 1), self.clock)
+            self.breakers[step] = breaker
+        self.count_fallback(step, "calls")
+        if not breaker.allow():
+            return self.run_fallback(step, option, frame, requests, "rejected")
+        start = time.perf_counter()
+        try:
+            delay_ms = self.faults.inject(step) if self.faults else 0.0
+            result = self.run_step(step, frame, requests)
+        except InjectedFault:
+            breaker.failure()
+            return self.run_fallback(step, option, frame, requests, "errors")
+        # the batch is executed at once, every request is charged its share of the measured time
+        elapsed_ms = (time.perf_counter() - start) * 1000.0 / max(requests.size, 1)
+        if elapsed_ms + delay_ms > option.get("timeout", float("inf")):
+            breaker.failure()
+            return self.run_fallback(step, option, frame, requests, "timeouts")
+        breaker.success()
+        return result
+
+    def run_chains(self, name, chains, options, frame, requests):
+        start = time.perf_counter()
+        outputs = list()
+        for chain in chains or []:
+            fallbacks = (chain.options or {}).get("fallbacks") or {}
+            result = frame
+            if chain.when:
+                result = concat_frames([self.run_guarded(step, frame, requests, fallbacks) for step in chain.when])
+            for step in chain.then or []:
+                result = self.run_guarded(step, result, requests, fallbacks)
+            outputs.append(self.apply_transforms(result, chain.transforms, options, name))
+        self.record(name, start)
+        return concat_frames(outputs) if outputs else frame
+
+    def run_layer(self, layer, frame, requests):
+        experiments = layer.experiments or []
+        if not experiments:
+            return frame
+        ratios = np.array([item.ratio for item in experiments], dtype=np.float64)
+        choices = self.random.choice(len(experiments), size=requests.size, p=ratios / ratios.sum())
+        request_ids = requests.column(REQUEST_ID)
+        outputs = list()
+        for position, item in enumerate(experiments):
+            chosen = request_ids[choices == position]
+            if not len(chosen):
+                continue
+            mask = np.isin(frame.column(REQUEST_ID), chosen)
+            request_mask = np.isin(request_ids, chosen)
+            outputs.append(self.run_step(item.name, frame.take(np.flatnonzero(mask)),
+                                         requests.take(np.flatnonzero(request_mask))))
+        return concat_frames(outputs)
+
+    def result_cache(self, scene, option):
+        cache = self.result_caches.get(scene)
+        if cache is None:
+            cache = ResultCache(option.get("maxEntries", 10000), option.get("ttl", 30), self.clock)
+            self.result_caches[scene] = cache
+        return cache
+
+    def result_cache_stats(self):
+        """hits, misses, evictions and hit rate of every scene result cache"""
+        return {scene: dict(cache.stats, hit_rate=cache.hit_rate()) for scene, cache in self.result_caches.items()}
+
+    def recommend(self, requests, scene="guess-you-like"):
+        """run a batch of request dicts through a scene, return the recommended rows of every request"""
+        if scene not in self.scenes:
+            raise ValueError("scene %s not found!" % scene)
+        scene_config = self.scenes[scene]
+        option = (scene_config.options or {}).get("resultCache")
+        if not option:
+            return self.run_scene(scene_config, requests)
+        cache = self.result_cache(scene, option)
+        keys = [tuple(request.get(name) for name in option.get("keyFields") or []) for request in requests]
+        results = [cache.get(key) for key in keys]
+        misses = [position for position, result in enumerate(results) if result is None]
+        # requests sharing a key in the same batch are computed once
+        pending = OrderedDict()
+        for position in misses:
+            pending.setdefault(keys[position], position)
+        computed = self.run_scene(scene_config, [requests[position] for position in pending.values()]) \
+            if pending else []
+        for key, result in zip(pending.keys(), computed):
+            cache.put(key, result)
+        computed = dict(zip(pending.keys(), computed))
+        for position in misses:
+            results[position] = computed[keys[position]]
+        return [list(result) for result in results]
+
+    def run_scene(self, scene_config, requests):
+        requests = Frame.from_rows(requests)
+        requests.set_column(REQUEST_ID, np.arange(requests.size, dtype=np.int64))
+        result = self.run_chains(scene_config.name, scene_config.chains, scene_config.options, requests, requests)
+        columns = [next(iter(column.keys())) for column in scene_config.columns or []] or \
+            [name for name in result.columns if name != REQUEST_ID]
+        values = [result.columns[name].tolist() if name in result.columns else [None] * result.size
+                  for name in columns]
+        results = [list() for _ in range(requests.size)]
+        rows = zip(*values) if values else [()] * result.size
+        for request, row in zip(result.column(REQUEST_ID).tolist(), rows):
+            results[request].append(dict(zip(columns, row)))
+        return results
+
+
+if __name__ == '__main__':
+    from online_generator import get_demo_jpa_flow
+    demo_users = [{"user_id": "u%d" % i, "user_bhv_item_seq": "\u0001".join("i%d" % j for j in range(i, i + 5))}
+                  for i in range(100)]
+    demo_items = [{"item_id": "i%d" % i, "brand": "b%d" % (i % 7), "category": "c%d" % (i % 3)} for i in range(200)]
+    demo_swing = [{"key": "i%d" % i, "value": [{"_1": "i%d" % ((i * 7 + j) % 200), "_2": 1.0 / (j + 1)}
+                                                for j in range(10)]} for i in range(200)]
+    demo_pop = [{"key": i, "value_list": [{"item_id": "i%d" % j, "score": 1.0} for j in range(i, i + 20)]}
+                for i in range(10)]
+    executor = ReferenceExecutor(get_demo_jpa_flow(), {
+        "amazonfashion_user_feature": demo_users, "amazonfashion_item_feature": demo_items,
+        "amazonfashion_item_summary": demo_items, "amazonfashion_swing": demo_swing,
+        "amazonfashion_pop": demo_pop})
+    begin = time.perf_counter()
+    recommends = executor.recommend([{"user_id": "u%d" % i, "item_id": ""} for i in range(1000)])
+    print("1000 requests cost %.3fs" % (time.perf_counter() - begin))
+    print(recommends[0][:5])
+    print(json.dumps({name: {"seconds": total, "calls": count} for name, (total, count) in executor.stats.items()},
+                     indent=2))
@@ -13,10 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne
+from bson import json_util
 from urllib.parse import quote_plus
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from decimal import Decimal
+import itertools
 import json
+import os
+import time
+
+
+CHECKPOINT_COLLECTION = "_load_checkpoint"
 
 
 def update_item(item):
@@ -30,8 +38,52 @@ def update_item(item):
         item["movie_id"] = str(item["movie_id"])
 
 
+def iter_json_documents(json_file_name, chunk_size=1 << 20):
+    """
+    stream documents from a json lines file or a mongoexport --jsonArray file without loading it whole,
+    mongo extended json ($oid, $numberDecimal, ...) is decoded to bson types
+    """
+    decoder = json.JSONDecoder(object_hook=json_util.object_hook)
+    with open(json_file_name, encoding='utf-8') as json_file:
+        buffer = ""
+        eof = False
+        while True:
+            pos = 0
+            while True:
+                while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] in "[],"):
+                    pos += 1
+                if pos >= len(buffer):
+                    break
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                    break
+                yield item
+                pos = end
+            buffer = buffer[pos:]
+            if eof:
+                return
+            chunk = json_file.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+
+
+def iter_batches(documents, batch_size):
+    batch = []
+    for item in documents:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 class MongodbSource(object):
     def __init__(self, host="localhost", port=27017, user="root", password="example"):
+        self._params = (host, port, user, password)
         uri = "mongodb://%s:%s@%s:%d" % (
             quote_plus(user), quote_plus(password), host, port)
         self._client = MongoClient(uri)
@@ -44,45 +96,127 @@ class MongodbSource(object):
         self._client[collect][table].insert_one(data)
 
     def insert_json(self, table, collect, json_file_name):
-        with open(json_file_name, encoding='utf-8') as json_file:
-            json_data = []
-            # json_data.extend(json.loads(json_file.read()))
-            for line in json_file.readlines():
-                json_data.append(json.loads(line))
-            for item in json_data:
-                update_item(item)
-                self._client[collect][table].insert_one(item)
+        return self.load_json(table, collect, json_file_name)
+
+    @staticmethod
+    def file_version(json_file_name):
+        """a rewritten file with the same name changes size or mtime and does not resume the old checkpoint"""
+        stat = os.stat(json_file_name)
+        return {"file": json_file_name, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    def get_checkpoint(self, table, collect, json_file_name):
+        checkpoint = self._client[collect][CHECKPOINT_COLLECTION].find_one({"_id": table})
+        version = self.file_version(json_file_name)
+        if not checkpoint or any(checkpoint.get(key) != value for key, value in version.items()):
+            return 0, False
+        return checkpoint.get("committed", 0), checkpoint.get("done", False)
+
+    def set_checkpoint(self, table, collect, json_file_name, committed, done=False):
+        self._client[collect][CHECKPOINT_COLLECTION].replace_one(
+            {"_id": table}, dict(self.file_version(json_file_name), _id=table, committed=committed, done=done),
+            upsert=True)
+
+    def insert_batch(self, table, collect, batch):
+        """unordered ReplaceOne upserts by _id, documents written by an interrupted run are overwritten"""
+        self._client[collect][table].bulk_write(
+            [ReplaceOne({"_id": item["_id"]}, item, upsert=True) for item in batch], ordered=False)
+
+    def load_json(self, table, collect, json_file_name, batch_size=1000, resume=True):
+        """
+        stream a json file into collect.table with batched unordered upserts.
+        documents keep the _id of the export, those without one get _id <table>:<line number>.
+        the committed count is checkpointed after every batch, so a rerun with resume continues after
+        the last committed batch without duplicating documents, that relies on the file keeping its line order.
+        a fresh load, without resume or a checkpoint of this file version, clears collect.table first.
+        """
+        start = time.perf_counter()
+        committed, done = self.get_checkpoint(table, collect, json_file_name) if resume else (0, False)
+        resumed_from = committed
+        if not committed and not done:
+            self._client[collect][table].delete_many({})
+        if not done:
+            documents = itertools.islice(enumerate(iter_json_documents(json_file_name)), committed, None)
+            for batch in iter_batches(documents, batch_size):
+                for index, item in batch:
+                    document_id = item.get("_id")
+                    update_item(item)
+                    item["_id"] = document_id if document_id is not None else "%s:%d" % (table, index)
+                self.insert_batch(table, collect, [item for _, item in batch])
+                committed = batch[-1][0] + 1
+                self.set_checkpoint(table, collect, json_file_name, committed)
+            self.set_checkpoint(table, collect, json_file_name, committed, done=True)
+        seconds = time.perf_counter() - start
+        loaded = committed - resumed_from
+        return {"table": table, "collection": collect, "documents": loaded, "resumed_from": resumed_from,
+                "seconds": seconds, "docs_per_second": loaded / seconds if seconds > 0 else 0.0}
 
     def count(self, table, collect):
         return self._client[collect][table].count_documents({})
 
 
-def put_demo_data(collection="movielens", host="192.168.221.128", port=27017):
+def load_job(params, table, collect, json_file_name, batch_size, resume):
+    return MongodbSource(*params).load_json(table, collect, json_file_name, batch_size, resume)
+
+
+def load_collections(mangodb_source, jobs, collect, workers=4, batch_size=1000, resume=True, processes=False,
+                     index_plan=None):
+    """
+    load {table: json file} concurrently, one worker per table.
+    processes=True uses a process pool with a client per process, for json decoding bound loads.
+    indexes of index_plan on the loaded tables are built once all of them are loaded.
+    """
+    start = time.perf_counter()
+    if processes:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(load_job, mangodb_source._params, table, collect, json_file_name, batch_size,
+                                   resume) for table, json_file_name in jobs.items()]
+            results = [future.result() for future in futures]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(mangodb_source.load_json, table, collect, json_file_name, batch_size, resume)
+                       for table, json_file_name in jobs.items()]
+            results = [future.result() for future in futures]
+    seconds = time.perf_counter() - start
+    for result in results:
+        print("%s insert over! %d documents in %.2fs, %.0f docs/s, resumed from %d" % (
+            result["table"], result["documents"], result["seconds"], result["docs_per_second"],
+            result["resumed_from"]))
+    documents = sum(result["documents"] for result in results)
+    print("all collections insert over! %d documents in %.2fs, %.0f docs/s" % (
+        documents, seconds, documents / seconds if seconds > 0 else 0.0))
+    if index_plan:
+        # the index plan is built by the generator at the repository root, the plain loader only needs pymongo
+        from index_plan import apply_index_plan
+        start = time.perf_counter()
+        report = apply_index_plan(mangodb_source._client, [spec for spec in index_plan if spec.collection in jobs],
+                                  database=collect)
+        print("indexes created: %s existing: %s in %.2fs" % (
+            ["%s.%s" % (spec["collection"], spec["field"]) for spec in report["created"]],
+            ["%s.%s" % (spec["collection"], spec["field"]) for spec in report["existing"]],
+            time.perf_counter() - start))
+    return results
+
+
+def put_demo_data(collection="movielens", host="192.168.221.128", port=27017, **kwargs):
     mangodb_source = MongodbSource(host, port)
-    mangodb_source.insert_json("user", collection, "./demo/user.json")
-    print("user insert over!", mangodb_source.count("user", collection))
-    mangodb_source.insert_json("item", collection, "./demo/item.json")
-    print("item insert over!", mangodb_source.count("item", collection))
-    mangodb_source.insert_json("item_feature", collection, "./demo/item_feature.json")
-    print("item_feature insert over!", mangodb_source.count("item_feature", collection))
-    mangodb_source.insert_json("itemcf", collection, "./demo/itemcf.json")
-    print("itemcf insert over!", mangodb_source.count("itemcf", collection))
-    mangodb_source.insert_json("swing", collection, "./demo/swing.json")
-    print("swing insert over!", mangodb_source.count("swing", collection))
-
-
-def put_jpa_data(collection="jpa", host="127.0.0.1", port=27017):
+    return load_collections(mangodb_source, {
+        "user": "./demo/user.json",
+        "item": "./demo/item.json",
+        "item_feature": "./demo/item_feature.json",
+        "itemcf": "./demo/itemcf.json",
+        "swing": "./demo/swing.json",
+    }, collection, **kwargs)
+
+
+def put_jpa_data(collection="jpa", host="127.0.0.1", port=27017, **kwargs):
     mangodb_source = MongodbSource(host, port)
-    mangodb_source.insert_json("amazonfashion_user_feature", collection, "./jpa/amazonfashion_user_feature.json")
-    print("user_feature insert over!", mangodb_source.count("amazonfashion_user_feature", collection))
-    mangodb_source.insert_json("amazonfashion_item_feature", collection, "./jpa/amazonfashion_item_feature.json")
-    print("item insert over!", mangodb_source.count("amazonfashion_item_feature", collection))
-    mangodb_source.insert_json("amazonfashion_item_summary", collection, "./jpa/amazonfashion_item_summary.json")
-    print("summary insert over!", mangodb_source.count("amazonfashion_item_summary", collection))
-    mangodb_source.insert_json("amazonfashion_swing", collection, "./jpa/amazonfashion_swing.json")
-    print("swing insert over!", mangodb_source.count("amazonfashion_swing", collection))
-    mangodb_source.insert_json("amazonfashion_pop", collection, "./jpa/amazonfashion_pop.json")
-    print("pop insert over!", mangodb_source.count("amazonfashion_pop", collection))
+    return load_collections(mangodb_source, {
+        "amazonfashion_user_feature": "./jpa/amazonfashion_user_feature.json",
+        "amazonfashion_item_feature": "./jpa/amazonfashion_item_feature.json",
+        "amazonfashion_item_summary": "./jpa/amazonfashion_item_summary.json",
+        "amazonfashion_swing": "./jpa/amazonfashion_swing.json",
+        "amazonfashion_pop": "./jpa/amazonfashion_pop.json",
+    }, collection, **kwargs)
 
 
 if __name__ == "__main__":